@@ -0,0 +1,117 @@
+"""Микробенчмарк метрик обработчиков: сколько HandlerMetricsMiddleware добавляет к обработке апдейта.
+
+    python -m bench.dispatch --updates 20000 --rounds 5 --output dispatch.json
+
+Один и тот же поток апдейтов (сообщения и нажатия кнопок) проходит через отдельный Dispatcher
+с пустыми обработчиками: без middleware и с HandlerMetricsMiddleware из bot.py. Сети и Bot API
+здесь нет, поэтому разница между прогонами — цена самой middleware на апдейт. Прогоны
+чередуются, в результат идет лучший из rounds, чтобы шум машины не попадал в разницу.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from aiogram import Bot, Dispatcher, F
+from aiogram.types import CallbackQuery, Message, Update
+
+from bench.run import configure_env
+
+
+def make_updates(count: int) -> list:
+    updates = []
+    for i in range(count):
+        user = {'id': 1000 + i % 100, 'is_bot': False, 'first_name': 'Bench'}
+        if i % 2:
+            raw = {'callback_query': {
+                'id': str(i), 'from': user, 'chat_instance': 'bench', 'data': f"event_next_{i}"
+            }}
+        else:
+            raw = {'message': {
+                'message_id': i, 'date': 0, 'chat': {'id': user['id'], 'type': 'private'}, 'from': user,
+                'text': "Поехали!"
+            }}
+        updates.append(Update.model_validate(dict(raw, update_id=i + 1)))
+    return updates
+
+
+def make_dispatcher(middleware=None) -> Dispatcher:
+    dp = Dispatcher()
+
+    @dp.message(F.text)
+    async def on_message(message: Message):
+        pass
+
+    @dp.callback_query()
+    async def on_callback(callback: CallbackQuery):
+        pass
+
+    if middleware is not None:
+        # Так же, как в bot.py: на сообщения и на нажатия кнопок
+        dp.message.middleware(middleware)
+        dp.callback_query.middleware(middleware)
+    return dp
+
+
+async def feed_all(dp: Dispatcher, bot: Bot, updates: list) -> float:
+    """Среднее время dp.feed_update на апдейт, мкс"""
+    started = time.perf_counter()
+    for update in updates:
+        await dp.feed_update(bot, update)
+    return (time.perf_counter() - started) / len(updates) * 1e6
+
+
+async def run_dispatch_benchmark(bot_module, updates: int = 20000, rounds: int = 5) -> dict:
+    metrics = bot_module.HandlerMetricsMiddleware()
+    plain, measured = make_dispatcher(), make_dispatcher(metrics)
+    stream = make_updates(updates)
+    bot = Bot(token=bot_module.API_TOKEN)
+    try:
+        # Разогрев: первые апдейты платят за ленивую инициализацию aiogram и pydantic
+        await feed_all(plain, bot, stream[:100])
+        await feed_all(measured, bot, stream[:100])
+        warmed = metrics.handled
+        baseline, with_metrics = [], []
+        for _ in range(rounds):
+            baseline.append(await feed_all(plain, bot, stream))
+            with_metrics.append(await feed_all(measured, bot, stream))
+    finally:
+        await bot.session.close()
+
+    baseline_us, with_metrics_us = min(baseline), min(with_metrics)
+    return {
+        'updates': updates,
+        'rounds': rounds,
+        'baseline_us': baseline_us,
+        'with_metrics_us': with_metrics_us,
+        'overhead_us': with_metrics_us - baseline_us,
+        'overhead_pct': (with_metrics_us - baseline_us) / baseline_us * 100 if baseline_us else 0.0,
+        # Middleware действительно видела каждый апдейт измеряемых прогонов
+        'handled': metrics.handled - warmed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--updates', type=int, default=20000, help="апдейтов в одном прогоне")
+    parser.add_argument('--rounds', type=int, default=5, help="прогонов с middleware и без")
+    parser.add_argument('--output', help="файл для JSON-результата (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    configure_env(keep_rate_limits=False)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot
+
+    result = asyncio.run(run_dispatch_benchmark(bot, args.updates, args.rounds))
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Локальные заменители Telegram Bot API и KudaGo для нагрузочных прогонов и тестов"""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter, deque
+
+from aiohttp import web
+
+# Методы Bot API, которые в ответ возвращают True, а не сообщение
+TRUE_METHODS = {
+    'answercallbackquery', 'deletemessage', 'deletewebhook', 'setwebhook', 'setmycommands', 'sendchataction',
+}
+
+
+class FakeServer:
+    """aiohttp-приложение на свободном локальном порту"""
+
+    def __init__(self):
+        self.app = web.Application()
+        self._runner = None
+        self.url = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+        return self
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+class FakeBotAPI(FakeServer):
+    """Bot API: отвечает правдоподобными сообщениями, считает вызовы и по желанию отдает 429.
+
+    chat_limit — сколько запросов в секунду принимается в одном чате, global_limit — всего;
+    сверх лимита приходит 429 с retry_after, как у Telegram.
+    """
+
+    def __init__(self, chat_limit: int = None, global_limit: int = None, retry_after: int = 1):
+        super().__init__()
+        self.chat_limit = chat_limit
+        self.global_limit = global_limit
+        self.retry_after = retry_after
+        self.calls = Counter()  # метод -> число принятых запросов
+        self.rejected = 0
+        self.sent = []  # (chat_id, метод, текст или подпись) в порядке приема
+        self.markups = {}  # chat_id -> клавиатура последнего сообщения
+        self.messages = {}  # chat_id -> последнее отправленное или измененное сообщение
+        self.photos = []  # (chat_id, file_id или ссылка; 'upload' для загруженного файла) по каждой картинке
+        self.updates = asyncio.Queue()  # апдейты, которые отдаст getUpdates
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+        self._recent = {}  # chat_id -> время последних запросов
+        self._recent_all = deque()
+        self.app.router.add_post('/bot{token}/{method}', self._handle)
+        self.app.router.add_get('/file/bot{token}/{path:.+}', self._file)
+
+    def _limited(self, chat_id) -> bool:
+        now = time.monotonic()
+        recent = self._recent.setdefault(chat_id, deque())
+        for window in (recent, self._recent_all):
+            while window and now - window[0] >= 1:
+                window.popleft()
+        if self.chat_limit is not None and len(recent) >= self.chat_limit:
+            return True
+        if self.global_limit is not None and len(self._recent_all) >= self.global_limit:
+            return True
+        recent.append(now)
+        self._recent_all.append(now)
+        return False
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method'].lower()
+        data = dict(await request.post())
+        chat_id = data.get('chat_id')
+
+        if method == 'getupdates':
+            return web.json_response({'ok': True, 'result': await self._get_updates(data)})
+        if method == 'getme':
+            return web.json_response({
+                'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+            })
+        if method == 'getfile':
+            return web.json_response({'ok': True, 'result': {
+                'file_id': data['file_id'], 'file_unique_id': data['file_id'], 'file_path': f"photos/{data['file_id']}.jpg"
+            }})
+
+        if chat_id is not None and self._limited(chat_id):
+            self.rejected += 1
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            })
+
+        self.calls[method] += 1
+        if method in TRUE_METHODS:
+            return web.json_response({'ok': True, 'result': True})
+
+        chat_id = int(chat_id or 0)
+        text = data.get('text') or data.get('caption')
+        photo = data.get('photo') if method == 'sendphoto' else None
+        if method == 'editmessagemedia':
+            # Новая картинка и подпись приходят одним JSON в поле media
+            media = json.loads(data['media'])
+            photo, text = media['media'], media.get('caption')
+        self.sent.append((chat_id, method, text))
+        if 'reply_markup' in data:
+            self.markups[chat_id] = json.loads(data['reply_markup'])
+        if photo is not None:
+            # Загруженный файл приходит частью multipart-запроса, а не строкой
+            uploaded = not isinstance(photo, str) or photo.startswith('attach://')
+            self.photos.append((chat_id, 'upload' if uploaded else photo))
+        message = {
+            'message_id': int(data.get('message_id') or next(self._message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+        }
+        if method in ('sendphoto', 'editmessagemedia'):
+            file_id = f"photo{next(self._file_ids)}"
+            message['photo'] = [{'file_id': file_id, 'file_unique_id': file_id, 'width': 800, 'height': 600}]
+            message['caption'] = text or ''
+        else:
+            message['text'] = text or ''
+        self.messages[chat_id] = message
+        return web.json_response({'ok': True, 'result': message})
+
+    async def _get_updates(self, data: dict) -> list:
+        # Long polling: ждем первый апдейт не дольше timeout, затем забираем все накопившиеся
+        timeout = float(data.get('timeout') or 0)
+        updates = []
+        try:
+            updates.append(await asyncio.wait_for(self.updates.get(), timeout or 0.01))
+        except asyncio.TimeoutError:
+            return []
+        while not self.updates.empty():
+            updates.append(self.updates.get_nowait())
+        return updates
+
+    async def _file(self, request: web.Request) -> web.Response:
+        return web.Response(body=b'\xff\xd8' + request.match_info['path'].encode() + b'\xff\xd9')
+
+    def callback_data(self, chat_id: int, prefix: str):
+        """callback_data первой кнопки последнего сообщения в чате, начинающейся с prefix"""
+        for row in self.markups.get(chat_id, {}).get('inline_keyboard', []):
+            for button in row:
+                if button.get('callback_data', '').startswith(prefix):
+                    return button['callback_data']
+        return None
+
+
+class FakeKudaGo(FakeServer):
+    """KudaGo: страницы событий с картинками, по желанию с задержкой ответа"""
+
+    def __init__(self, events: int = 60, page_size: int = 20, delay: float = 0):
+        super().__init__()
+        self.events = events
+        self.page_size = page_size
+        self.delay = delay
+        self.requests = 0
+        self.app.router.add_get('/events/', self._events)
+        self.app.router.add_get('/images/{name}', self._image)
+
+    async def _events(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        page = int(request.query.get('page', '1'))
+        start = (page - 1) * self.page_size
+        results = [
+            {
+                'id': event_id,
+                'title': f"Событие {event_id}",
+                'place': {'name': f"Площадка {event_id % 7}", 'address': f"ул. Тестовая, {event_id}"},
+                'price': f"{event_id * 100} ₽",
+                'images': [{'image': f"{self.url}/images/{event_id}.jpg"}],
+                'site_url': f"https://kudago.com/event/{event_id}/",
+            }
+            for event_id in range(start + 1, min(start + self.page_size, self.events) + 1)
+        ]
+        next_url = None
+        if start + self.page_size < self.events:
+            query = dict(request.query, page=str(page + 1))
+            next_url = str(request.url.with_query(query))
+        return web.json_response({'count': self.events, 'next': next_url, 'results': results})
+
+    async def _image(self, request: web.Request) -> web.Response:
+        return web.Response(body=b'\xff\xd8' + bytes(4096) + b'\xff\xd9', content_type='image/jpeg')
+
+
+class FakeUsers:
+    """Пользователи, которые пишут боту: апдейты подаются прямо в dp и ждут конца обработки"""
+
+    def __init__(self, bot_module, api: FakeBotAPI):
+        self.bot = bot_module
+        self.api = api
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def _user(self, user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': 'Bench'}
+
+    def _message(self, user_id: int, text: str, from_bot: bool = False) -> dict:
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'} if from_bot else self._user(user_id),
+            'text': text,
+        }
+
+    def message(self, user_id: int, text: str) -> dict:
+        return {'message': self._message(user_id, text)}
+
+    def callback(self, user_id: int, data: str) -> dict:
+        return {'callback_query': {
+            'id': str(next(self._message_ids)),
+            'from': self._user(user_id),
+            'chat_instance': 'bench',
+            'data': data,
+            # Кнопка нажата на последнем сообщении бота: от его типа зависит, можно ли его отредактировать
+            'message': self.api.messages.get(user_id) or self._message(user_id, 'card', from_bot=True),
+        }}
+
+    async def send(self, update: dict):
+        await self.bot.dp.feed_raw_update(self.bot.bot, dict(update, update_id=next(self._update_ids)))
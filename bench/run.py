@@ -0,0 +1,296 @@
+"""Нагрузочный прогон bot.py: синтетические апдейты через настоящий dp против локальных заменителей.
+
+    python -m bench.run --mode feed --users 100 --output bench.json
+    DATABASE_URL=postgresql://localhost/bench python -m bench.run --mode webhook --scenarios events,memory,history
+
+Режимы доставки апдейтов: feed — dp.feed_raw_update в том же процессе, webhook — POST в локальный
+webhook бота, polling — dp.start_polling с getUpdates фейкового Bot API. Bot API и KudaGo заменяются
+локальными серверами из bench.fakes. Сценарии memory и history пишут в Postgres из DATABASE_URL,
+без него они пропускаются. Результат — JSON с пропускной способностью, перцентилями задержки,
+числом вызовов Bot API на апдейт и сводкой performance_summary() бота.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from datetime import date, timedelta
+
+import aiohttp
+from aiohttp import web
+from aiogram.client.telegram import TelegramAPIServer
+
+from bench.fakes import FakeBotAPI, FakeKudaGo, FakeUsers
+
+# Пользователи прогона: их записи в БД удаляются до и после прогона
+BENCH_USER_BASE = 900_000_000
+WEBHOOK_SECRET = 'bench-secret'
+
+
+def configure_env(keep_rate_limits: bool):
+    """Настройки бота на время прогона; заданные в окружении значения не перезаписываются"""
+    os.environ.setdefault('BOT_TOKEN', '123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi')
+    os.environ.setdefault('WEBHOOK_SECRET', WEBHOOK_SECRET)
+    os.environ.setdefault('WARMUP_ENABLED', '0')
+    os.environ.setdefault('METRICS_PORT', '0')
+    os.environ.setdefault('NAVIGATION_DEBOUNCE', '0')
+    if not keep_rate_limits:
+        # Фейковый Bot API лимитов не держит: меряем бота, а не ожидание токенов
+        os.environ.setdefault('OUTBOUND_CHAT_RATE', '100000')
+        os.environ.setdefault('OUTBOUND_CHAT_BURST', '100000')
+        os.environ.setdefault('OUTBOUND_GLOBAL_RATE', '100000')
+        os.environ.setdefault('OUTBOUND_GLOBAL_BURST', '100000')
+
+
+def percentile(sorted_values: list, q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(q * len(sorted_values)))]
+
+
+class Bench(FakeUsers):
+    """Отправляет апдейты выбранным способом и ждет, пока dp их обработает"""
+
+    def __init__(self, bot_module, api: FakeBotAPI, mode: str):
+        super().__init__(bot_module, api)
+        self.mode = mode
+        self.webhook_url = None
+        self._done = {}  # update_id -> future, завершается после обработки апдейта
+        self.latencies = []
+        self.errors = 0
+        bot_module.dp.update.outer_middleware(self._track)
+
+    async def _track(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            future = self._done.pop(event.update_id, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    async def send(self, update: dict):
+        update_id = next(self._update_ids)
+        update = dict(update, update_id=update_id)
+        done = asyncio.get_running_loop().create_future()
+        self._done[update_id] = done
+        started = time.perf_counter()
+        if self.mode == 'feed':
+            try:
+                await self.bot.dp.feed_raw_update(self.bot.bot, update)
+            except Exception:
+                pass
+        elif self.mode == 'webhook':
+            async with self._http.post(
+                self.webhook_url, json=update, headers={'X-Telegram-Bot-Api-Secret-Token': self.bot.WEBHOOK_SECRET}
+            ) as response:
+                response.raise_for_status()
+        else:
+            self.api.updates.put_nowait(update)
+        await done
+        self.latencies.append(time.perf_counter() - started)
+
+    async def __aenter__(self):
+        self._http = aiohttp.ClientSession()
+        return self
+
+    async def close(self):
+        # dp общий для всех прогонов в процессе: middleware прогона снимается вместе с ним
+        self.bot.dp.update.outer_middleware.unregister(self._track)
+        await self._http.close()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# Сценарии: последовательность апдейтов одного пользователя, ответы бота читаются из фейкового Bot API
+async def events_scenario(bench: Bench, user_id: int, steps: int):
+    await bench.send(bench.message(user_id, "Поехали!"))
+    await bench.send(bench.callback(user_id, "category_concert"))
+    await bench.send(bench.callback(user_id, "date_today_concert"))
+    for _ in range(steps):
+        data = bench.api.callback_data(user_id, 'event_next_')
+        if data is None:
+            break
+        await bench.send(bench.callback(user_id, data))
+
+
+async def memory_scenario(bench: Bench, user_id: int, steps: int):
+    for _ in range(max(1, steps // 6)):
+        await bench.send(bench.message(user_id, "На память"))
+        await bench.send(bench.callback(user_id, "memory_date_today"))
+        await bench.send(bench.message(user_id, f"Место {random.randint(1, 50)}"))
+        await bench.send(bench.callback(user_id, f"rating_{random.randint(1, 10)}"))
+        await bench.send(bench.message(user_id, "Отличный день"))
+        await bench.send(bench.callback(user_id, "skip_photo"))
+
+
+async def history_scenario(bench: Bench, user_id: int, steps: int):
+    await bench.send(bench.message(user_id, "История"))
+    await bench.send(bench.callback(user_id, "history_month"))
+    for _ in range(steps):
+        data = bench.api.callback_data(user_id, 'memory_next_')
+        if data is None:
+            break
+        await bench.send(bench.callback(user_id, data))
+
+
+SCENARIOS = {
+    'events': events_scenario,
+    'memory': memory_scenario,
+    'history': history_scenario,
+}
+DB_SCENARIOS = {'memory', 'history'}
+
+
+async def reset_bench_users(pool, user_ids: list):
+    async with pool.acquire() as conn:
+        for table in ('memories', 'memory_stats_monthly', 'memory_stats_places', 'user_cities'):
+            await conn.execute(f"DELETE FROM {table} WHERE user_id = ANY($1::bigint[])", user_ids)
+
+
+async def seed_history(pool, user_ids: list, per_user: int):
+    """Воспоминания за последний месяц; сводки статистики сценарию истории не нужны"""
+    today = date.today()
+    for user_id in user_ids:
+        records = [
+            (user_id, today - timedelta(days=i % 30), f"Место {i % 50}", i % 10 + 1, f"Описание {i}")
+            for i in range(per_user)
+        ]
+        async with pool.acquire() as conn:
+            await conn.copy_records_to_table(
+                'memories', records=records, columns=['user_id', 'date', 'place', 'rating', 'description']
+            )
+
+
+async def run_scenario(bench: Bench, kudago: FakeKudaGo, name: str, user_ids: list, steps: int) -> dict:
+    bench.latencies = []
+    bench.errors = 0
+    api_calls = sum(bench.api.calls.values())
+    kudago_requests = kudago.requests
+
+    started = time.perf_counter()
+    await asyncio.gather(*(SCENARIOS[name](bench, user_id, steps) for user_id in user_ids))
+    duration = time.perf_counter() - started
+
+    latencies = sorted(bench.latencies)
+    updates = len(latencies)
+    api_calls = sum(bench.api.calls.values()) - api_calls
+    return {
+        'updates': updates,
+        'errors': bench.errors,
+        'duration_s': duration,
+        'updates_per_s': updates / duration if duration else 0.0,
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'bot_api_calls': api_calls,
+        'bot_api_calls_per_update': api_calls / updates if updates else 0.0,
+        'kudago_requests': kudago.requests - kudago_requests,
+    }
+
+
+async def run_benchmark(bot_module, mode: str = 'feed', scenarios=('events',), users: int = 50, steps: int = 10,
+                        history_memories: int = 1000, kudago_delay: float = 0) -> dict:
+    api = await FakeBotAPI().start()
+    kudago = await FakeKudaGo(delay=kudago_delay).start()
+    saved_api, saved_kudago_url = bot_module.bot.session.api, bot_module.kudago.base_url
+    bot_module.bot.session.api = TelegramAPIServer.from_base(api.url)
+    bot_module.kudago.base_url = kudago.url
+
+    user_ids = [BENCH_USER_BASE + i for i in range(users)]
+    results = {}
+    runner = polling = None
+    try:
+        if bot_module.DATABASE_URL:
+            bot_module.pool = await bot_module.init_db()
+            bot_module.memory_writer.start()
+            await reset_bench_users(bot_module.pool, user_ids)
+            if 'history' in scenarios:
+                await seed_history(bot_module.pool, user_ids, history_memories)
+
+        async with Bench(bot_module, api, mode) as bench:
+            if mode == 'webhook':
+                runner = web.AppRunner(bot_module.webhook_app())
+                await runner.setup()
+                site = web.TCPSite(runner, '127.0.0.1', 0)
+                await site.start()
+                port = site._server.sockets[0].getsockname()[1]
+                bench.webhook_url = f"http://127.0.0.1:{port}{bot_module.WEBHOOK_PATH}"
+            elif mode == 'polling':
+                polling = asyncio.create_task(
+                    bot_module.dp.start_polling(bot_module.bot, handle_signals=False, polling_timeout=1)
+                )
+            else:
+                await bot_module.dp.emit_startup(bot=bot_module.bot)
+
+            for name in scenarios:
+                if name in DB_SCENARIOS and bot_module.pool is None:
+                    results[name] = {'skipped': 'нужен DATABASE_URL'}
+                    continue
+                results[name] = await run_scenario(bench, kudago, name, user_ids, steps)
+    finally:
+        if bot_module.pool is not None:
+            await bot_module.memory_writer.close()
+            await reset_bench_users(bot_module.pool, user_ids)
+        # Остановка бота тем же путем, что и в работе: on_shutdown дописывает очередь и закрывает ресурсы
+        if runner is not None:
+            await runner.cleanup()
+        elif polling is not None:
+            await bot_module.dp.stop_polling()
+            await polling
+        else:
+            await bot_module.dp.emit_shutdown(bot=bot_module.bot)
+            await bot_module.bot.session.close()
+        await api.close()
+        await kudago.close()
+        bot_module.bot.session.api, bot_module.kudago.base_url = saved_api, saved_kudago_url
+
+    return {
+        'mode': mode,
+        'users': users,
+        'steps': steps,
+        'scenarios': results,
+        'bot': bot_module.performance_summary(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=('feed', 'webhook', 'polling'), default='feed')
+    parser.add_argument('--scenarios', default='events,memory,history',
+                        help="через запятую: " + ", ".join(SCENARIOS))
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--steps', type=int, default=10, help="нажатий навигации на пользователя")
+    parser.add_argument('--history-memories', type=int, default=1000, help="воспоминаний на пользователя")
+    parser.add_argument('--kudago-delay', type=float, default=0, help="задержка ответа KudaGo, с")
+    parser.add_argument('--keep-rate-limits', action='store_true', help="не снимать лимиты исходящих запросов")
+    parser.add_argument('--output', help="файл для JSON-результата (по умолчанию stdout)")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(',') if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+
+    configure_env(args.keep_rate_limits)
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import bot
+
+    result = asyncio.run(run_benchmark(
+        bot, args.mode, scenarios, args.users, args.steps, args.history_memories, args.kudago_delay
+    ))
+    output = json.dumps(result, ensure_ascii=False, indent=2, default=str)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,43 @@
 import os
+import asyncio
+import hashlib
+import html
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import random
+import signal
+import tempfile
+import contextvars
+import itertools
+import weakref
 import asyncpg
+import aiohttp
+from aiohttp import web
 from datetime import datetime, timedelta
 from datetime import datetime, date as date_class
+from collections import Counter as CallCounter, OrderedDict, deque
+from contextlib import asynccontextmanager, aclosing
+from dataclasses import dataclass, astuple
+from zoneinfo import ZoneInfo
 from aiogram.types import ReplyKeyboardRemove 
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.filters import Command
-from aiogram.types import Message, CallbackQuery, InputMediaPhoto, FSInputFile
+from aiogram import Bot, Dispatcher, BaseMiddleware, types, F
+from aiogram.filters import Command, ExceptionTypeFilter
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.methods import DeleteMessage
+from aiogram.types import Message, CallbackQuery, InputMediaPhoto
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
+from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-import requests
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import time
 import redis
 from io import BytesIO
@@ -18,16 +46,241 @@ from dotenv import load_dotenv
 # Загрузка переменных окружения
 load_dotenv()
 
+
+# Структурированные логи: JSON в stdout через очередь, запись идет в отдельном потоке
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+
+# Стандартные поля LogRecord; все остальное пришло через extra и попадает в JSON
+_LOG_RECORD_FIELDS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        payload = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_FIELDS:
+                payload[key] = value
+        if record.exc_info:
+            payload['exc'] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    # aiogram пишет строку на каждый апдейт — на нашем объеме это только шум
+    logging.getLogger('aiogram.event').setLevel(os.getenv('AIOGRAM_EVENT_LOG_LEVEL', 'WARNING'))
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    return listener
+
+
+logger = logging.getLogger('bot')
+
 # Инициализация бота
 API_TOKEN = os.getenv('BOT_TOKEN')
 DATABASE_URL = os.getenv('DATABASE_URL')
-bot = Bot(token=API_TOKEN)
-dp = Dispatcher()
+REDIS_URL = os.getenv('REDIS_URL')
+
+# Хранилище фото воспоминаний: local (каталог PHOTO_DIR) или s3 (S3/MinIO)
+PHOTO_STORE = os.getenv('PHOTO_STORE', 'local')
+PHOTO_DIR = os.getenv('PHOTO_DIR', 'photos')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+S3_BUCKET = os.getenv('S3_BUCKET', 'memories')
+S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY')
+S3_SECRET_KEY = os.getenv('S3_SECRET_KEY')
+S3_REGION = os.getenv('S3_REGION', 'us-east-1')
+
+# Пакетная запись воспоминаний в БД
+MEMORY_WRITE_BATCH = int(os.getenv('MEMORY_WRITE_BATCH', '200'))
+MEMORY_WRITE_INTERVAL = float(os.getenv('MEMORY_WRITE_INTERVAL', '0.05'))
+MEMORY_WRITE_QUEUE = int(os.getenv('MEMORY_WRITE_QUEUE', '10000'))
+MEMORY_WRITE_BACKOFF_MAX = float(os.getenv('MEMORY_WRITE_BACKOFF_MAX', '30'))  # потолок паузы между повторами, с
+# Кэш истории: сколько пользователей и сколько страниц/карточек на пользователя держать в памяти
+MEMORY_CACHE_USERS = int(os.getenv('MEMORY_CACHE_USERS', '1000'))
+MEMORY_CACHE_ENTRIES = int(os.getenv('MEMORY_CACHE_ENTRIES', '200'))
+# Сколько секунд запись кэша истории живет, даже если история не менялась
+MEMORY_CACHE_TTL = int(os.getenv('MEMORY_CACHE_TTL', '300'))
+# Название места в сводке статистики обрезается, чтобы помещаться в ключ индекса
+STATS_PLACE_MAX_LENGTH = 200
+# Пробельные символы по краям названия места: одинаково отрезаются в Python (str.strip) и в SQL (btrim)
+STATS_PLACE_TRIM = ' \t\n\r\f\v'
+# Серии дней подряд ищутся только за последний год: запрос не растет с длиной истории
+STATS_STREAK_DAYS = 365
+
+# Эндпоинт /metrics для Prometheus (0 — выключен)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+# Свой сервер Bot API (telegram-bot-api или заглушка для нагрузочных прогонов) вместо api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+# Файл, куда при остановке сохраняется сводка производительности (JSON) для сравнения прогонов
+STATS_DUMP_PATH = os.getenv('STATS_DUMP_PATH')
+
+# Режим получения апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_BASE_URL = os.getenv('WEBHOOK_BASE_URL', '')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+MEMORY_PREFETCH = int(os.getenv('MEMORY_PREFETCH', '5'))
+HANDLER_CONCURRENCY = int(os.getenv('HANDLER_CONCURRENCY', '100'))
+SHUTDOWN_TIMEOUT = float(os.getenv('SHUTDOWN_TIMEOUT', '30'))
+
+# Ограничение исходящих запросов к Bot API: сообщений в секунду на чат и всего, повторы после 429.
+# За любую секунду уходит не больше rate + burst запросов. Запас на чат вмещает весь путь от
+# "Поехали!" до первых карточек, дальше листание ограничено rate; удаления лимит чата не тратят
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '3'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '10'))
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '25'))
+OUTBOUND_GLOBAL_BURST = int(os.getenv('OUTBOUND_GLOBAL_BURST', '5'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+# Пауза, за которую серия быстрых нажатий "Дальше"/"Назад" схлопывается в одно
+NAVIGATION_DEBOUNCE = float(os.getenv('NAVIGATION_DEBOUNCE', '0.15'))
+
+# Хранилище состояний FSM: memory (по умолчанию без Redis) или redis
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'redis' if REDIS_URL else 'memory')
+FSM_REDIS_URL = os.getenv('FSM_REDIS_URL', REDIS_URL)
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '86400'))
+
+# Настройки пула подключений к PostgreSQL
+DB_POOL_MIN_SIZE = int(os.getenv('DB_POOL_MIN_SIZE', '2'))
+DB_POOL_MAX_SIZE = int(os.getenv('DB_POOL_MAX_SIZE', '10'))
+DB_ACQUIRE_TIMEOUT = float(os.getenv('DB_ACQUIRE_TIMEOUT', '5'))
+DB_COMMAND_TIMEOUT = float(os.getenv('DB_COMMAND_TIMEOUT', '10'))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '100'))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv('DB_MAX_INACTIVE_LIFETIME', '300'))
+
+# Настройки KudaGo API
+KUDAGO_API_URL = os.getenv('KUDAGO_API_URL', 'https://kudago.com/public-api/v1.4')
+KUDAGO_TIMEOUT = float(os.getenv('KUDAGO_TIMEOUT', '10'))
+KUDAGO_RETRIES = int(os.getenv('KUDAGO_RETRIES', '2'))
+KUDAGO_POOL_SIZE = int(os.getenv('KUDAGO_POOL_SIZE', '20'))
+
+# Настройки кэша событий
+EVENTS_CACHE_TTL = int(os.getenv('EVENTS_CACHE_TTL', '600'))
+EVENTS_CACHE_SIZE = int(os.getenv('EVENTS_CACHE_SIZE', '1000'))
+# Размер страницы KudaGo и запас загруженных событий впереди пользователя
+EVENTS_PAGE_SIZE = int(os.getenv('EVENTS_PAGE_SIZE', '20'))
+EVENTS_LOOKAHEAD = int(os.getenv('EVENTS_LOOKAHEAD', '5'))
+# Сколько еще секунд после EVENTS_CACHE_TTL можно отдавать устаревшие события, обновляя их в фоне
+EVENTS_CACHE_STALE_TTL = int(os.getenv('EVENTS_CACHE_STALE_TTL', '3600'))
+
+# Города KudaGo: slug -> (название, часовой пояс). "Сегодня" и "завтра" считаются по местному времени города
+CITIES = {
+    'spb': ('Санкт-Петербург', 'Europe/Moscow'),
+    'msk': ('Москва', 'Europe/Moscow'),
+    'kzn': ('Казань', 'Europe/Moscow'),
+    'nnv': ('Нижний Новгород', 'Europe/Moscow'),
+    'sochi': ('Сочи', 'Europe/Moscow'),
+    'ekb': ('Екатеринбург', 'Asia/Yekaterinburg'),
+    'nsk': ('Новосибирск', 'Asia/Novosibirsk'),
+    'krasnoyarsk': ('Красноярск', 'Asia/Krasnoyarsk'),
+}
+DEFAULT_CITY = os.getenv('DEFAULT_CITY', 'spb')
+USER_CITY_CACHE_SIZE = int(os.getenv('USER_CITY_CACHE_SIZE', '10000'))
+# Сколько секунд город пользователя живет в кэше, прежде чем перечитывается из Redis/БД
+USER_CITY_TTL = int(os.getenv('USER_CITY_TTL', '60'))
+
+# Фоновый прогрев популярных запросов
+WARMUP_ENABLED = os.getenv('WARMUP_ENABLED', '1') == '1'
+WARMUP_INTERVAL = int(os.getenv('WARMUP_INTERVAL', '300'))
+WARMUP_CATEGORIES = os.getenv('WARMUP_CATEGORIES', 'concert,exhibition,fun').split(',')
+WARMUP_CITIES = os.getenv('WARMUP_CITIES', DEFAULT_CITY).split(',')
+WARMUP_IMAGES = int(os.getenv('WARMUP_IMAGES', '0'))  # сколько первых картинок каждого запроса готовить заранее
+# Бюджет фоновых запросов к KudaGo: запросов в секунду и допустимый всплеск
+KUDAGO_RATE_LIMIT = float(os.getenv('KUDAGO_RATE_LIMIT', '1'))
+KUDAGO_RATE_BURST = int(os.getenv('KUDAGO_RATE_BURST', '3'))
+IMAGE_FILE_ID_CACHE_SIZE = int(os.getenv('IMAGE_FILE_ID_CACHE_SIZE', '10000'))
+
+# Предзагрузка картинок следующих карточек событий
+IMAGE_PREFETCH_AHEAD = int(os.getenv('IMAGE_PREFETCH_AHEAD', '3'))
+IMAGE_PREFETCH_CONCURRENCY = int(os.getenv('IMAGE_PREFETCH_CONCURRENCY', '4'))
+IMAGE_PREFETCH_BUDGET = int(os.getenv('IMAGE_PREFETCH_BUDGET', str(32 * 1024 * 1024)))
+# Служебный чат, куда картинки загружаются заранее ради file_id (необязательно)
+IMAGE_CACHE_CHAT_ID = int(os.getenv('IMAGE_CACHE_CHAT_ID', '0')) or None
+# Без служебного чата предзагрузка только находит сохраненные file_id. Скачивать байты заранее
+# и загружать их в Telegram самому — это исходящий трафик бота, поэтому только по явному включению
+IMAGE_PREFETCH_BYTES = os.getenv('IMAGE_PREFETCH_BYTES', '0') == '1'
+# Свой лимит загрузок в служебный чат: предзагрузка не упирается в 1 сообщение/с на чат,
+# но и не забирает весь общий лимит у пользователей
+IMAGE_CACHE_CHAT_RATE = float(os.getenv('IMAGE_CACHE_CHAT_RATE', '5'))
+
+# Настройки сессий просмотра событий и воспоминаний
+SESSION_TTL = int(os.getenv('SESSION_TTL', '3600'))
+SESSION_MAX_SIZE = int(os.getenv('SESSION_MAX_SIZE', '100000'))
+
+ADMIN_IDS = {int(x) for x in os.getenv('ADMIN_IDS', '').split(',') if x.strip()}
+
+
+# Недописанные диалоги хранятся в Redis, чтобы их видели все процессы бота и они переживали деплой
+def create_fsm_storage():
+    if FSM_STORAGE == 'redis':
+        return RedisStorage.from_url(
+            FSM_REDIS_URL,
+            state_ttl=FSM_STATE_TTL,
+            data_ttl=FSM_STATE_TTL
+        )
+    return MemoryStorage()
+
+
+def create_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        return Bot(token=API_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    return Bot(token=API_TOKEN)
+
+
+bot = create_bot()
+dp = Dispatcher(storage=create_fsm_storage())
 
 # Глобальная переменная для пула подключений
 pool = None
 
 
+# Перцентиль по отсортированному списку значений
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+# Метрики Prometheus
+HANDLER_LATENCY = Histogram(
+    'bot_handler_duration_seconds', 'Время работы обработчика апдейта', ['handler']
+)
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках апдейтов', ['handler']
+)
+TELEGRAM_LATENCY = Histogram(
+    'bot_telegram_request_duration_seconds', 'Время запроса к Telegram Bot API', ['method']
+)
+TELEGRAM_ERRORS = Counter(
+    'bot_telegram_request_errors_total', 'Ошибки запросов к Telegram Bot API', ['method']
+)
+KUDAGO_LATENCY = Histogram(
+    'bot_kudago_request_duration_seconds', 'Время HTTP-запроса к KudaGo и CDN картинок', ['host', 'status']
+)
+DB_QUERY_LATENCY = Histogram(
+    'bot_db_query_duration_seconds', 'Время выполнения подготовленного запроса', ['query']
+)
+DB_ACQUIRE_WAIT = Histogram(
+    'bot_db_acquire_wait_seconds', 'Ожидание свободного соединения пула'
+)
+
+
 # Состояния FSM
 class MemoryStates(StatesGroup):
     waiting_for_date = State()
@@ -37,48 +290,369 @@ class MemoryStates(StatesGroup):
     waiting_for_photo = State()
     waiting_for_start_date = State()
     waiting_for_end_date = State()
-    waiting_for_custom_date = State()ы
+    waiting_for_custom_date = State()
+
+
+# Подключение к Redis (необязательное, включается через REDIS_URL)
+redis_client = redis.asyncio.from_url(REDIS_URL) if REDIS_URL else None
+
+
+# Хранилище сессий просмотра (какой список листает пользователь и на какой карточке он сейчас)
+class LocalSessionStore:
+    """Сессии в памяти процесса с TTL и вытеснением давно неактивных пользователей"""
+
+    def __init__(self, ttl: int, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._sessions = OrderedDict()  # (kind, user_id) -> (expires_at, session)
+
+    async def get(self, kind: str, user_id: int):
+        key = (kind, user_id)
+        entry = self._sessions.get(key)
+        if entry is None:
+            return None
+        expires_at, session = entry
+        if expires_at < time.monotonic():
+            del self._sessions[key]
+            return None
+        self._sessions.move_to_end(key)
+        return dict(session)
+
+    async def set(self, kind: str, user_id: int, session: dict):
+        key = (kind, user_id)
+        self._sessions[key] = (time.monotonic() + self.ttl, dict(session))
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > self.max_size:
+            self._sessions.popitem(last=False)
+
+    async def delete(self, kind: str, user_id: int):
+        self._sessions.pop((kind, user_id), None)
+
+
+class RedisSessionStore:
+    """Сессии в Redis: общие для нескольких процессов бота и переживают перезапуск"""
+
+    def __init__(self, redis_client, ttl: int):
+        self.redis = redis_client
+        self.ttl = ttl
+
+    @staticmethod
+    def _key(kind: str, user_id: int) -> str:
+        return f"session:{kind}:{user_id}"
+
+    async def get(self, kind: str, user_id: int):
+        raw = await self.redis.get(self._key(kind, user_id))
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, kind: str, user_id: int, session: dict):
+        await self.redis.set(self._key(kind, user_id), json.dumps(session, ensure_ascii=False), ex=self.ttl)
+
+    async def delete(self, kind: str, user_id: int):
+        await self.redis.delete(self._key(kind, user_id))
+
+
+if redis_client is not None:
+    sessions = RedisSessionStore(redis_client, SESSION_TTL)
+else:
+    sessions = LocalSessionStore(SESSION_TTL, SESSION_MAX_SIZE)
+
+# Запросы, которые подготавливаются один раз на каждом соединении пула
+MEMORY_CARD_COLUMNS = "id, date, place, rating, description, photo_path, photo_file_id"
+
+PREPARED_QUERIES = {
+    'insert_memory': """INSERT INTO memories
+        (user_id, date, place, rating, description, photo_file_id)
+        VALUES ($1, $2, $3, $4, $5, $6)""",
+    'memories_first': f"""SELECT {MEMORY_CARD_COLUMNS} FROM memories
+        WHERE user_id = $1 AND date BETWEEN $2 AND $3
+        ORDER BY date DESC, id DESC
+        LIMIT $4""",
+    'memories_older': f"""SELECT {MEMORY_CARD_COLUMNS} FROM memories
+        WHERE user_id = $1 AND date BETWEEN $2 AND $3 AND (date, id) < ($4, $5)
+        ORDER BY date DESC, id DESC
+        LIMIT $6""",
+    'memories_newer': f"""SELECT {MEMORY_CARD_COLUMNS} FROM memories
+        WHERE user_id = $1 AND date BETWEEN $2 AND $3 AND (date, id) > ($4, $5)
+        ORDER BY date ASC, id ASC
+        LIMIT $6""",
+    'set_memory_photo_path': "UPDATE memories SET photo_path = $1 WHERE user_id = $2 AND photo_file_id = $3",
+    'set_memory_photo_file_id': "UPDATE memories SET photo_file_id = $1 WHERE id = $2",
+    'get_event_image': "SELECT file_id FROM event_images WHERE image_url = $1",
+    'save_event_image': """INSERT INTO event_images (image_url, file_id) VALUES ($1, $2)
+        ON CONFLICT (image_url) DO UPDATE SET file_id = EXCLUDED.file_id, updated_at = NOW()""",
+    'delete_event_image': "DELETE FROM event_images WHERE image_url = $1",
+    'add_memory_stats_monthly': """INSERT INTO memory_stats_monthly (user_id, month, memories, rated, rating_sum)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id, month) DO UPDATE SET
+            memories = memory_stats_monthly.memories + EXCLUDED.memories,
+            rated = memory_stats_monthly.rated + EXCLUDED.rated,
+            rating_sum = memory_stats_monthly.rating_sum + EXCLUDED.rating_sum""",
+    'add_memory_stats_places': """INSERT INTO memory_stats_places (user_id, place, memories, rated, rating_sum)
+        VALUES ($1, $2, $3, $4, $5)
+        ON CONFLICT (user_id, place) DO UPDATE SET
+            memories = memory_stats_places.memories + EXCLUDED.memories,
+            rated = memory_stats_places.rated + EXCLUDED.rated,
+            rating_sum = memory_stats_places.rating_sum + EXCLUDED.rating_sum""",
+    'memory_stats_months': """SELECT month, memories, rated, rating_sum FROM memory_stats_monthly
+        WHERE user_id = $1
+        ORDER BY month DESC""",
+    'memory_stats_top_places': """SELECT place, memories, rating_sum::float8 / rated AS avg_rating
+        FROM memory_stats_places
+        WHERE user_id = $1 AND rated > 0
+        ORDER BY avg_rating DESC, memories DESC
+        LIMIT $2""",
+    # Серии дней подряд с воспоминаниями с даты $2: "острова" дат, у которых date - номер по порядку одинаков
+    'memory_streaks': """WITH days AS (
+            SELECT DISTINCT date FROM memories WHERE user_id = $1 AND date >= $2
+        ), islands AS (
+            SELECT MAX(date) AS last_day, COUNT(*) AS length
+            FROM (SELECT date, date - (ROW_NUMBER() OVER (ORDER BY date))::int AS grp FROM days) numbered
+            GROUP BY grp
+        )
+        SELECT
+            (SELECT MAX(length) FROM islands) AS longest,
+            (SELECT length FROM islands ORDER BY last_day DESC LIMIT 1) AS latest_length,
+            (SELECT MAX(last_day) FROM islands) AS latest_day""",
+    'get_user_city': "SELECT city FROM user_cities WHERE user_id = $1",
+    'set_user_city': """INSERT INTO user_cities (user_id, city) VALUES ($1, $2)
+        ON CONFLICT (user_id) DO UPDATE SET city = EXCLUDED.city, updated_at = NOW()""",
+}
 
 
-# Глобальные переменные для пагинации
-current_event_index = {}
-current_memory_index = {}
+class BotConnection(asyncpg.Connection):
+    """Соединение пула с заранее подготовленными запросами бота"""
+    prepared: dict
 
-# Глобальные переменные для кэша
-events_cache = {}
-memories_cache = {}
 
+async def init_connection(conn: BotConnection):
+    conn.prepared = {}
+    for name, query in PREPARED_QUERIES.items():
+        conn.prepared[name] = await conn.prepare(query)
 
-# Подключение к Redis
-# redis_client = redis.Redis(host='localhost', port=6379, db=0)
 
 # Подключение к PostgreSQL и автоматическое заполнение
 async def init_db():
     global pool  # Используем глобальную переменную
     try:
-        # Создаем пул подключений
-        pool = await asyncpg.create_pool(DATABASE_URL)
-
-        # Создаем таблицу воспоминаний, если она не существует
-        async with pool.acquire() as conn:
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS memories (
-                    id SERIAL PRIMARY KEY,
-                    user_id BIGINT NOT NULL,
-                    date TEXT NOT NULL,
-                    place TEXT,
-                    rating INTEGER,
-                    description TEXT,
-                    photo_path TEXT,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
+        # Схему создаем отдельным соединением: запросы пула подготавливаются уже по готовым таблицам
+        conn = await asyncpg.connect(DATABASE_URL)
+        try:
+            await migrate_db(conn)
+        finally:
+            await conn.close()
+
+        # Создаем пул подключений; min_size соединений открываются и подготавливаются сразу
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            connection_class=BotConnection,
+            init=init_connection
+        )
 
-        print("Таблица 'memories' успешно создана/проверена")
+        logger.info("Таблица 'memories' успешно создана/проверена")
         return pool
-    except Exception as e:
-        print(f"Ошибка при создании таблицы: {e}")
+    except Exception:
+        logger.exception("Ошибка при создании таблицы")
+        raise
+
+
+# Получение соединения из пула с учетом времени ожидания
+class PoolStats:
+    """Счетчики ожидания свободного соединения пула"""
+
+    def __init__(self):
+        self.acquires = 0
+        self.timeouts = 0
+        self.waiting = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def snapshot(self) -> dict:
+        return {
+            'size': pool.get_size() if pool else 0,
+            'idle': pool.get_idle_size() if pool else 0,
+            'max_size': pool.get_max_size() if pool else 0,
+            'waiting': self.waiting,
+            'acquires': self.acquires,
+            'timeouts': self.timeouts,
+            'avg_wait_ms': self.total_wait / self.acquires * 1000 if self.acquires else 0.0,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+
+pool_stats = PoolStats()
+
+
+@asynccontextmanager
+async def acquire_connection():
+    started = time.perf_counter()
+    pool_stats.waiting += 1
+    try:
+        conn = await pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+    except asyncio.TimeoutError:
+        pool_stats.timeouts += 1
         raise
+    finally:
+        pool_stats.waiting -= 1
+
+    wait = time.perf_counter() - started
+    DB_ACQUIRE_WAIT.observe(wait)
+    pool_stats.acquires += 1
+    pool_stats.total_wait += wait
+    pool_stats.max_wait = max(pool_stats.max_wait, wait)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
+
+
+# Выполнение подготовленных запросов по имени из PREPARED_QUERIES
+async def db_fetch(name: str, *args):
+    async with acquire_connection() as conn:
+        with DB_QUERY_LATENCY.labels(name).time():
+            return await conn.prepared[name].fetch(*args)
+
+
+async def db_fetchval(name: str, *args):
+    async with acquire_connection() as conn:
+        with DB_QUERY_LATENCY.labels(name).time():
+            return await conn.prepared[name].fetchval(*args)
+
+
+async def db_executemany(name: str, args: list):
+    async with acquire_connection() as conn:
+        with DB_QUERY_LATENCY.labels(name).time():
+            await conn.prepared[name].executemany(args)
+
+
+async def db_executemany_atomic(steps: list):
+    """Несколько executemany в одной транзакции: [(имя запроса, аргументы), ...]"""
+    async with acquire_connection() as conn:
+        async with conn.transaction():
+            for name, args in steps:
+                if not args:
+                    continue
+                with DB_QUERY_LATENCY.labels(name).time():
+                    await conn.prepared[name].executemany(args)
+
+
+# Создание и миграция таблиц
+async def migrate_db(conn):
+    # Создаем таблицу воспоминаний, если она не существует
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS memories (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            date DATE NOT NULL,
+            place TEXT,
+            rating INTEGER,
+            description TEXT,
+            photo_path TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+    # Миграция: file_id фото из Telegram, чтобы не загружать файл повторно.
+    # У старых записей он заполняется при первом показе карточки
+    await conn.execute(
+        "ALTER TABLE memories ADD COLUMN IF NOT EXISTS photo_file_id TEXT"
+    )
+
+    # Миграция: дата хранилась строкой ДД.ММ.ГГГГ, переводим столбец в DATE вместе с данными
+    date_type = await conn.fetchval(
+        """SELECT data_type FROM information_schema.columns
+        WHERE table_name = 'memories' AND column_name = 'date'"""
+    )
+    if date_type == 'text':
+        await conn.execute(
+            "ALTER TABLE memories ALTER COLUMN date TYPE DATE USING TO_DATE(date, 'DD.MM.YYYY')"
+        )
+        logger.info("Столбец memories.date переведен в тип DATE")
+
+    # Индекс под выборку истории пользователя за период и постраничный проход по (date, id)
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS memories_user_date_id_idx ON memories (user_id, date DESC, id DESC)"
+    )
+    await conn.execute("DROP INDEX IF EXISTS memories_user_date_idx")
+
+    # file_id картинок событий, уже загруженных в Telegram
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS event_images (
+            image_url TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+    # Сводки для статистики: по пользователю и месяцу и по пользователю и месту.
+    # Обновляются вместе со вставкой воспоминаний
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS memory_stats_monthly (
+            user_id BIGINT NOT NULL,
+            month DATE NOT NULL,
+            memories INTEGER NOT NULL,
+            rated INTEGER NOT NULL,
+            rating_sum BIGINT NOT NULL,
+            PRIMARY KEY (user_id, month)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS memory_stats_places (
+            user_id BIGINT NOT NULL,
+            place TEXT NOT NULL,
+            memories INTEGER NOT NULL,
+            rated INTEGER NOT NULL,
+            rating_sum BIGINT NOT NULL,
+            PRIMARY KEY (user_id, place)
+        )
+    ''')
+    await backfill_memory_stats(conn)
+
+    # Выбранный пользователем город для афиши
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_cities (
+            user_id BIGINT PRIMARY KEY,
+            city TEXT NOT NULL,
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+
+
+# Сводки пересобираются по memories при каждом запуске, если разошлись с ней: при первом создании,
+# после записей процессом без сводок или после смены правил нормализации мест
+async def backfill_memory_stats(conn) -> bool:
+    drifted = await conn.fetchval('''
+        SELECT (SELECT COUNT(*) FROM memories) <> (SELECT COALESCE(SUM(memories), 0) FROM memory_stats_monthly)
+            OR (SELECT COUNT(*) FROM memories WHERE btrim(place, $1) <> '')
+                <> (SELECT COALESCE(SUM(memories), 0) FROM memory_stats_places)
+    ''', STATS_PLACE_TRIM)
+    if not drifted:
+        return False
+
+    async with conn.transaction():
+        # Вставки воспоминаний ждут конца пересборки, иначе их прибавки к сводкам потерялись бы
+        await conn.execute("LOCK TABLE memories IN SHARE MODE")
+        await conn.execute("DELETE FROM memory_stats_monthly")
+        await conn.execute("DELETE FROM memory_stats_places")
+        await conn.execute('''
+            INSERT INTO memory_stats_monthly (user_id, month, memories, rated, rating_sum)
+            SELECT user_id, date_trunc('month', date)::date, COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0)
+            FROM memories
+            GROUP BY 1, 2
+        ''')
+        await conn.execute(f'''
+            INSERT INTO memory_stats_places (user_id, place, memories, rated, rating_sum)
+            SELECT user_id, left(btrim(place, $1), {STATS_PLACE_MAX_LENGTH}), COUNT(*), COUNT(rating), COALESCE(SUM(rating), 0)
+            FROM memories
+            WHERE btrim(place, $1) <> ''
+            GROUP BY 1, 2
+        ''', STATS_PLACE_TRIM)
+    logger.info("Сводки статистики воспоминаний пересобраны")
+    return True
 
 
 # Начальное меню
@@ -88,7 +662,11 @@ async def show_main_menu(message: Message, text: str = None):
         types.KeyboardButton(text="Поехали!"),
         types.KeyboardButton(text="На память")
     )
-    builder.row(types.KeyboardButton(text="История"))
+    builder.row(
+        types.KeyboardButton(text="История"),
+        types.KeyboardButton(text="Статистика")
+    )
+    builder.row(types.KeyboardButton(text="Город"))
 
     
 
@@ -105,6 +683,78 @@ async def cmd_start(message: Message):
     await show_main_menu(message, welcome_text)
 
 
+# Статистика кэша событий для администраторов
+@dp.message(Command("cache_stats"))
+async def cmd_cache_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    stats = events_query_cache.stats()
+    await message.answer(
+        "📊 Кэш событий KudaGo\n"
+        f"Попадания: {stats['hits']} (Redis: {stats['redis_hits']})\n"
+        f"Промахи: {stats['misses']}, объединено: {stats['collapsed']}\n"
+        f"Запросов к API: {stats['upstream_calls']}\n"
+        f"Устаревших ответов: {stats['stale_hits']}, фоновых обновлений: {stats['refreshes']}\n"
+        f"Прогревов: {cache_warmer.runs}, запросов прогрева: {stats['warmups']}\n"
+        f"Hit rate: {stats['hit_rate']:.1%}, записей: {stats['size']}\n"
+        f"Задержка p50/p99: {stats['p50_ms']:.1f} / {stats['p99_ms']:.1f} мс"
+        + "".join(
+            f"\n{CITIES[city][0] if city in CITIES else city}: {city_stats['lookups']} обращений, "
+            f"{city_stats['misses']} промахов, hit rate {city_stats['hit_rate']:.1%}; "
+            f"фоновых обновлений {city_stats['revalidations']}, прогрева {city_stats['warmups']}"
+            for city, city_stats in stats['by_label'].items()
+        )
+    )
+
+
+# Статистика записи в БД для администраторов
+@dp.message(Command("db_stats"))
+async def cmd_db_stats(message: Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+
+    db = pool_stats.snapshot()
+    await message.answer(
+        "🗄 Запись воспоминаний\n"
+        f"Записано: {memory_writer.inserted} ({memory_writer.batches} пачек)\n"
+        f"Скорость за минуту: {memory_writer.inserts_per_second():.1f} вставок/с\n"
+        f"В очереди: {memory_writer.pending}, ошибок: {memory_writer.failed}\n"
+        f"Кэш истории: {memory_history_cache.hits} попаданий, {memory_history_cache.misses} промахов\n\n"
+        "🔌 Пул соединений\n"
+        f"Открыто: {db['size']} из {db['max_size']}, свободно: {db['idle']}, ждут: {db['waiting']}\n"
+        f"Ожидание: среднее {db['avg_wait_ms']:.1f} мс, максимум {db['max_wait_ms']:.1f} мс\n"
+        f"Таймаутов получения соединения: {db['timeouts']}"
+    )
+
+
+# Выбор города
+@dp.message(Command("city"))
+@dp.message(F.text == "Город")
+async def choose_city(message: Message):
+    current = await get_user_city(message.from_user.id)
+
+    builder = InlineKeyboardBuilder()
+    for slug, (name, _) in CITIES.items():
+        builder.button(text=f"✅ {name}" if slug == current else name, callback_data=f"city_{slug}")
+    builder.adjust(2)
+
+    await message.answer("Выберите город:", reply_markup=builder.as_markup())
+
+
+@dp.callback_query(F.data.startswith("city_"))
+async def handle_city_selection(callback: CallbackQuery):
+    city = callback.data.split("_", 1)[1]
+    if city not in CITIES:
+        await callback.answer("Неизвестный город")
+        return
+
+    await set_user_city(callback.from_user.id, city)
+    await callback.message.edit_text(f"Город: {CITIES[city][0]}")
+    await show_main_menu(callback.message)
+    await callback.answer()
+
+
 # Обработчик кнопки "Поехали!"
 @dp.message(F.text == "Поехали!")
 async def ask_interests(message: Message):
@@ -121,26 +771,418 @@ async def ask_interests(message: Message):
     )
     builder.row(types.InlineKeyboardButton(text="Назад", callback_data="main_menu"))
 
+    city = await get_user_city(message.from_user.id)
     await message.answer(
-        "Выберите категорию:",
+        f"Выберите категорию ({CITIES[city][0]}):",
         reply_markup=builder.as_markup()
     )
 
-# Простая реализация "кэша" в памяти для текущего пользователя
-async def get_events_from_cache(user_id: int):
-    events = events_cache.get(user_id)
-    
-    return events
+# Асинхронный клиент KudaGo API
+class KudaGoClient:
+    """Клиент KudaGo с общим пулом keep-alive соединений и повторами запросов"""
+
+    def __init__(self, base_url: str, timeout: float = 10, retries: int = 2,
+                 backoff: float = 0.5, pool_size: int = 20):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.pool_size = pool_size
+        self._session = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Сессия создается лениво, уже внутри работающего event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.pool_size,
+                keepalive_timeout=30,
+                ttl_dns_cache=300
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                trace_configs=[self._metrics_trace_config()]
+            )
+        return self._session
+
+    @staticmethod
+    def _metrics_trace_config() -> aiohttp.TraceConfig:
+        # Время каждого HTTP-запроса (включая повторы) попадает в KUDAGO_LATENCY
+        async def on_request_start(session, ctx, params):
+            ctx.started = time.perf_counter()
+
+        async def on_request_end(session, ctx, params):
+            KUDAGO_LATENCY.labels(params.url.host, str(params.response.status)).observe(
+                time.perf_counter() - ctx.started
+            )
+
+        async def on_request_exception(session, ctx, params):
+            KUDAGO_LATENCY.labels(params.url.host, 'error').observe(time.perf_counter() - ctx.started)
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_end.append(on_request_end)
+        trace_config.on_request_exception.append(on_request_exception)
+        return trace_config
+
+    async def _sleep_before_retry(self, attempt: int):
+        # Экспоненциальная задержка со случайным разбросом, чтобы повторы не шли волной
+        delay = self.backoff * (2 ** attempt)
+        await asyncio.sleep(random.uniform(delay / 2, delay * 1.5))
+
+    async def get_json(self, path: str, params: dict = None):
+        """GET-запрос к API, возвращает разобранный JSON или None"""
+        url = path if path.startswith('http') else f"{self.base_url}/{path.lstrip('/')}"
+
+        for attempt in range(self.retries + 1):
+            try:
+                async with self._get_session().get(url, params=params) as response:
+                    if response.status == 200:
+                        return await response.json()
 
+                    logger.warning("API вернуло статус %s", response.status, extra={'url': url})
+                    # Ошибки клиента (кроме 429) повторять бессмысленно
+                    if response.status < 500 and response.status != 429:
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Ошибка при запросе к API: %r", e, extra={'url': url, 'attempt': attempt})
 
-# Получение событий из KudaGo API
-async def get_events(category: str, date_input: str):
-    """Улучшенная версия функции для получения событий"""
+            if attempt < self.retries:
+                await self._sleep_before_retry(attempt)
+
+        return None
+
+    async def get_bytes(self, url: str, max_size: int = None):
+        """Скачивание файла (например, картинки события) без повторов; файл больше max_size не скачивается"""
+        try:
+            async with self._get_session().get(url) as response:
+                if response.status == 200:
+                    if max_size is None:
+                        return await response.read()
+                    if (response.content_length or 0) > max_size:
+                        return None
+                    content = bytearray()
+                    async for chunk in response.content.iter_chunked(64 * 1024):
+                        content += chunk
+                        if len(content) > max_size:
+                            return None
+                    return bytes(content)
+                logger.error("Картинка %s вернула статус %s", url, response.status)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.error("Не удалось скачать картинку %s: %r", url, e)
+        return None
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+kudago = KudaGoClient(
+    KUDAGO_API_URL,
+    timeout=KUDAGO_TIMEOUT,
+    retries=KUDAGO_RETRIES,
+    pool_size=KUDAGO_POOL_SIZE
+)
+
+
+# Общий кэш результатов запросов к KudaGo
+def events_cache_key(location: str, category: str, since_day: date_class, until_day: date_class, page: int = 1) -> str:
+    return f"kudago:events:{location}:{category}:{since_day.isoformat()}:{until_day.isoformat()}:{page}"
+
+
+class EventsQueryCache:
+    """Кэш запросов событий: LRU в памяти процесса и необязательный Redis с TTL.
+
+    Запись свежая ttl секунд, затем еще stale_ttl секунд отдается как есть,
+    а в фоне запрашивается новая версия (stale-while-revalidate).
+    """
+
+    def __init__(self, ttl: int, max_size: int, redis_client=None, encode=None, decode=None, stale_ttl: int = 0):
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_size = max_size
+        self.redis = redis_client
+        # Преобразование значений в JSON для Redis и обратно
+        self.encode = encode or (lambda value: value)
+        self.decode = decode or (lambda value: value)
+        self._local = OrderedDict()  # key -> (fresh_until, expires_at, value)
+        self._inflight = {}  # key -> asyncio.Future для одновременных промахов
+        self._revalidating = {}  # key -> фоновая задача обновления устаревшей записи
+        self._latencies = deque(maxlen=1000)
+        self.hits = 0
+        self.redis_hits = 0
+        self.misses = 0
+        self.collapsed = 0
+        self.upstream_calls = 0
+        self.stale_hits = 0
+        self.refreshes = 0
+        self.warmups = 0
+        # метка (город) -> обращения пользователей и запросы к API по причинам:
+        # промах пользователя, фоновое обновление устаревшей записи, прогрев
+        self.by_label = {}
+
+    def _count(self, label, counter: str):
+        if label is None:
+            return
+        counters = self.by_label.setdefault(label, dict.fromkeys(('lookups', 'miss', 'revalidate', 'warmup'), 0))
+        counters[counter] += 1
+
+    def _get_local(self, key: str):
+        """Возвращает (значение, устарело ли оно)"""
+        entry = self._local.get(key)
+        if entry is None:
+            return None, False
+        fresh_until, expires_at, value = entry
+        now = time.monotonic()
+        if expires_at < now:
+            del self._local[key]
+            return None, False
+        self._local.move_to_end(key)
+        return value, fresh_until < now
+
+    def _set_local(self, key: str, value, age: float = 0):
+        now = time.monotonic() - age
+        self._local[key] = (now + self.ttl, now + self.ttl + self.stale_ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.max_size:
+            self._local.popitem(last=False)
+
+    async def _get_redis(self, key: str):
+        if self.redis is None:
+            return None
+        try:
+            raw = await self.redis.get(key)
+        except Exception as e:
+            logger.error("Redis недоступен: %s", e)
+            return None
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        return self.decode(entry['value']), max(0.0, time.time() - entry['fetched_at'])
+
+    async def _set_redis(self, key: str, value):
+        if self.redis is None:
+            return
+        try:
+            entry = {'fetched_at': time.time(), 'value': self.encode(value)}
+            await self.redis.set(key, json.dumps(entry, ensure_ascii=False), ex=self.ttl + self.stale_ttl)
+        except Exception as e:
+            logger.error("Redis недоступен: %s", e)
+
+    async def _load(self, key: str, fetch, label=None):
+        """Возвращает (значение, устарело ли оно); устаревшую запись из Redis обновляет вызывающий"""
+        cached = await self._get_redis(key)
+        if cached is not None:
+            self.redis_hits += 1
+            value, age = cached
+            self._set_local(key, value, age)
+            return value, age > self.ttl
+
+        self.misses += 1
+        return await self.refresh(key, fetch, label, reason='miss'), False
+
+    async def refresh(self, key: str, fetch, label=None, reason: str = 'warmup'):
+        """Запрашивает значение заново и обновляет оба уровня кэша.
+
+        reason — причина запроса к API: 'miss', 'revalidate' или 'warmup'.
+        """
+        self.upstream_calls += 1
+        if reason == 'warmup':
+            self.warmups += 1
+        self._count(label, reason)
+        value = await fetch()
+        if value is None:
+            return None
+        await self._set_redis(key, value)
+        self._set_local(key, value)
+        return value
+
+    def _revalidate(self, key: str, fetch, label=None):
+        if key in self._revalidating or key in self._inflight:
+            return
+
+        async def revalidate():
+            try:
+                self.refreshes += 1
+                await self.refresh(key, fetch, label, reason='revalidate')
+            except Exception:
+                logger.exception("Не удалось обновить устаревшую запись кэша", extra={'key': key})
+
+        task = asyncio.create_task(revalidate())
+        self._revalidating[key] = task
+        task.add_done_callback(lambda _: self._revalidating.pop(key, None))
+
+    async def get_or_fetch(self, key: str, fetch, label=None):
+        """Возвращает значение из кэша или вызывает fetch() ровно один раз на ключ"""
+        started = time.perf_counter()
+        self._count(label, 'lookups')
+        try:
+            value, stale = self._get_local(key)
+            if value is not None:
+                self.hits += 1
+                if stale:
+                    # Пользователь не ждет KudaGo: отдаем то, что есть, и обновляем в фоне
+                    self.stale_hits += 1
+                    self._revalidate(key, fetch, label)
+                return value
+
+            future = self._inflight.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return await asyncio.shield(future)
+
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[key] = future
+            stale = False
+            try:
+                value, stale = await self._load(key, fetch, label)
+                future.set_result(value)
+                return value
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                future.set_exception(e)
+                # Исключение уже передано ожидающим, чтобы не было предупреждения о неполученной ошибке
+                future.exception()
+                raise
+            finally:
+                del self._inflight[key]
+                # Пока ключ в _inflight, _revalidate считает, что обновление уже идет
+                if stale:
+                    self._revalidate(key, fetch, label)
+        finally:
+            self._latencies.append(time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+        lookups = self.hits + self.redis_hits + self.misses + self.collapsed
+        return {
+            'hits': self.hits,
+            'redis_hits': self.redis_hits,
+            'misses': self.misses,
+            'collapsed': self.collapsed,
+            'upstream_calls': self.upstream_calls,
+            'stale_hits': self.stale_hits,
+            'refreshes': self.refreshes,
+            'warmups': self.warmups,
+            'hit_rate': (lookups - self.misses) / lookups if lookups else 0.0,
+            'size': len(self._local),
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+            # hit rate по метке считается только по обращениям пользователей:
+            # прогрев и фоновые обновления идут к API без промаха и учитываются отдельно
+            'by_label': {
+                label: {
+                    'lookups': counters['lookups'],
+                    'misses': counters['miss'],
+                    'revalidations': counters['revalidate'],
+                    'warmups': counters['warmup'],
+                    'hit_rate': 1 - counters['miss'] / counters['lookups'] if counters['lookups'] else 0.0,
+                }
+                for label, counters in self.by_label.items()
+            },
+        }
+
+
+# Компактная карточка события: из ответа KudaGo остается только то, что показывается пользователю
+@dataclass(frozen=True, slots=True, weakref_slot=True)
+class EventCard:
+    id: int
+    caption: str
+    image_url: str = None
+
+
+# Карточки общие для всех записей кэша и пользователей: одно событие — один объект
+event_cards = weakref.WeakValueDictionary()
+
+
+def intern_event_card(card: EventCard) -> EventCard:
+    if card.id is None:
+        return card
+    existing = event_cards.get(card.id)
+    if existing == card:
+        return existing
+    event_cards[card.id] = card
+    return card
+
+
+# Ссылка на первую картинку события KudaGo
+def event_image_url(event: dict):
+    images = event.get('images', [])
+    if images and isinstance(images, list):
+        first_image = images[0]
+        if isinstance(first_image, dict):
+            return first_image.get('image')
+    return None
+
+
+# Текст карточки события
+def event_caption(event: dict) -> str:
+    title = event.get('title', 'Без названия')
+
+    # Обработка места
+    place_data = event.get('place', {})
+    if isinstance(place_data, dict):
+        place_name = place_data.get('name', '')
+        address = place_data.get('address', '')
+        place_text = f"{place_name}, {address}" if place_name else address
+    else:
+        place_text = str(place_data) if place_data else 'Место не указано'
+
+    # Обработка цены
+    price_data = event.get('price', '')
+    if isinstance(price_data, dict):
+        price_text = price_data.get('name', 'Цена не указана')
+    else:
+        price_text = str(price_data) if price_data else 'Цена не указана'
+
+    url = event.get('site_url', 'https://kudago.com')
+
+    return (
+        f"🎟 <b>{title}</b>\n\n"
+        f"📍 <b>Место:</b> {place_text if place_text else 'Адрес не указан'}\n"
+        f"💰 <b>Цена:</b> {price_text}\n"
+        f"🌐 <b>Сайт:</b> <a href='{url}'>Подробнее</a>"
+    )
+
+
+def normalize_event(event: dict) -> EventCard:
+    """Превращает событие KudaGo в карточку с заранее собранной подписью"""
+    return intern_event_card(EventCard(event.get('id'), event_caption(event), event_image_url(event)))
+
+
+events_query_cache = EventsQueryCache(
+    EVENTS_CACHE_TTL,
+    EVENTS_CACHE_SIZE,
+    redis_client,
+    stale_ttl=EVENTS_CACHE_STALE_TTL,
+    # Значение кэша — страница KudaGo: (карточки, ссылка на следующую страницу)
+    encode=lambda page: [[astuple(card) for card in page[0]], page[1]],
+    decode=lambda raw: (tuple(intern_event_card(EventCard(*row)) for row in raw[0]), raw[1]),
+)
+
+
+# Часовой пояс и дата "сегодня"/"завтра"/ДД.ММ.ГГГГ в городе
+def city_timezone(city: str) -> ZoneInfo:
+    return ZoneInfo(CITIES.get(city, CITIES[DEFAULT_CITY])[1])
+
+
+def city_day(city: str, date_input: str) -> date_class:
+    if date_input == 'today':
+        return datetime.now(city_timezone(city)).date()
+    if date_input == 'tomorrow':
+        return datetime.now(city_timezone(city)).date() + timedelta(days=1)
+    return datetime.strptime(date_input, "%d.%m.%Y").date()
+
+
+# Параметры запроса событий KudaGo и ключ кэша его первой страницы
+def events_query(category: str, date_input: str, city: str = DEFAULT_CITY):
     params = {
-        'location': 'spb',
-        'page_size': 20,  
+        'location': city,
+        'page_size': EVENTS_PAGE_SIZE,
         'lang': 'ru',
-        'fields': 'id,title,place,price,images,site_url,description',  
+        'fields': 'id,title,place,price,images,site_url',
         'expand': 'place',  
         'text_format': 'plain'  
     }
@@ -153,131 +1195,538 @@ async def get_events(category: str, date_input: str):
     }
     params['categories'] = category_map.get(category, 'all')
 
-   
-    try:
-        if date_input == 'today':
-            since = datetime.now()
-            until = since + timedelta(days=1)
-        elif date_input == 'tomorrow':
-            since = datetime.now() + timedelta(days=1)
-            until = since + timedelta(days=1)
-        else:
-            
-            since = datetime.strptime(date_input, "%d.%m.%Y")
-            until = since + timedelta(days=1)
+    # Календарные сутки в часовом поясе города: одинаковые запросы за день дают одинаковый ключ кэша
+    day = city_day(city, date_input)
+    since = datetime.combine(day, datetime.min.time(), tzinfo=city_timezone(city))
+    until = since + timedelta(days=1)
 
-       
-        params['actual_since'] = int(since.timestamp())
-        params['actual_until'] = int(until.timestamp())
+    params['actual_since'] = int(since.timestamp())
+    params['actual_until'] = int(until.timestamp())
+    return params, (params['location'], params['categories'], day, day + timedelta(days=1))
+
+
+# Загрузка одной страницы событий: (карточки, ссылка на следующую страницу) или None при ошибке
+def event_page_fetcher(url: str, params: dict = None):
+    async def fetch():
+        data = await kudago.get_json(url, params=params)
+        if data is None:
+            # Ошибку API не кэшируем, следующий запрос попробует снова
+            return None
 
-        
-        response = requests.get(
-            'https://kudago.com/public-api/v1.4/events/',
-            params=params,
-            timeout=10
-        )
-        
-       
-        if response.status_code != 200:
-            print(f"API вернуло статус {response.status_code}")
-            return []
-            
-        data = response.json()
-        
-        
         if not data.get('results'):
-            print("API вернуло пустой список событий")
-            return []
-            
-        return data['results']
+            logger.info("API вернуло пустой список событий", extra={'params': params, 'url': url})
+            return (), None
+
+        # В кэше держим только компактные карточки, исходный JSON сразу отпускаем
+        return tuple(normalize_event(event) for event in data['results']), data.get('next')
+
+    return fetch
+
+
+# Ленивый обход страниц KudaGo по ссылкам next: следующая страница запрашивается, только когда она нужна
+async def iter_event_pages(category: str, date_input: str, city: str = DEFAULT_CITY):
+    params, key_parts = events_query(category, date_input, city)
+    url = 'events/'
+    page = 1
 
+    while True:
+        fetch = event_page_fetcher(url, params)
+        value = await events_query_cache.get_or_fetch(events_cache_key(*key_parts, page=page), fetch, label=city)
+        if value is None:
+            return
+        cards, next_url = value
+        yield cards, next_url is not None
+        if next_url is None:
+            return
+        # Ссылка next уже содержит все параметры запроса
+        url, params = next_url, None
+        page += 1
+
+
+# Получение событий из KudaGo API
+async def get_events(category: str, date_input: str, city: str = DEFAULT_CITY, need: int = EVENTS_PAGE_SIZE):
+    """Загружает страницы, пока событий меньше need; возвращает (события, есть ли еще страницы)"""
+    events = []
+    has_more = False
+    try:
+        async with aclosing(iter_event_pages(category, date_input, city)) as pages:
+            async for cards, has_more in pages:
+                events.extend(cards)
+                if len(events) >= need:
+                    break
+    except Exception:
+        logger.exception("Ошибка при запросе к API")
+    return events, has_more
+
+
+# Ограничитель частоты запросов (token bucket)
+class TokenBucket:
+    """rate токенов в секунду, не больше burst подряд"""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self):
+        async with self._lock:
+            self._refill()
+            while self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self._refill()
+            self.tokens -= 1
+
+
+kudago_budget = TokenBucket(KUDAGO_RATE_LIMIT, KUDAGO_RATE_BURST)
+
+
+# Фоновый прогрев популярных запросов: сегодня/завтра по основным категориям
+class CacheWarmer:
+    """Обновляет первые страницы популярных запросов раньше, чем они устареют, и сразу после полуночи"""
+
+    def __init__(self, interval: int, cities: list, categories: list, budget: TokenBucket, image_count: int = 0):
+        self.interval = interval
+        self.cities = cities
+        self.categories = categories
+        self.budget = budget
+        self.image_count = image_count
+        self._task = None
+        self.runs = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _next_delay(self) -> float:
+        # После полуночи в городе ключи "сегодня" и "завтра" меняются, поэтому обновляемся сразу после нее
+        delay = self.interval
+        for city in self.cities:
+            now = datetime.now(city_timezone(city))
+            midnight = datetime.combine(now.date() + timedelta(days=1), datetime.min.time(), tzinfo=now.tzinfo)
+            delay = min(delay, (midnight - now).total_seconds() + 1)
+        return max(1.0, delay)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.warm()
+            except Exception:
+                logger.exception("Ошибка прогрева кэша событий")
+            await asyncio.sleep(self._next_delay())
+
+    async def warm(self):
+        for city in self.cities:
+            for date_input in ('today', 'tomorrow'):
+                for category in self.categories:
+                    await self.budget.acquire()
+                    params, key_parts = events_query(category, date_input, city)
+                    page = await events_query_cache.refresh(
+                        events_cache_key(*key_parts), event_page_fetcher('events/', params), label=city,
+                        reason='warmup'
+                    )
+                    if page is None or not self.image_count:
+                        continue
+                    for card in page[0][:self.image_count]:
+                        if card.image_url:
+                            await self.budget.acquire()
+                            await image_prefetcher.warm(card.image_url)
+        self.runs += 1
+        logger.info("Кэш событий прогрет", extra={'runs': self.runs})
+
+
+cache_warmer = CacheWarmer(WARMUP_INTERVAL, WARMUP_CITIES, WARMUP_CATEGORIES, kudago_budget, WARMUP_IMAGES)
+
+
+# Город пользователя: LRU с TTL в памяти поверх таблицы user_cities.
+# Если задан Redis, город читается через него: смена города видна всем процессам сразу
+user_cities = OrderedDict()  # user_id -> (city, expires_at)
+
+
+def _user_city_key(user_id: int) -> str:
+    return f"user_city:{user_id}"
+
+
+def _remember_city_locally(user_id: int, city: str):
+    user_cities[user_id] = (city, time.monotonic() + USER_CITY_TTL)
+    user_cities.move_to_end(user_id)
+    while len(user_cities) > USER_CITY_CACHE_SIZE:
+        user_cities.popitem(last=False)
+
+
+async def _remember_city(user_id: int, city: str):
+    if redis_client is None:
+        _remember_city_locally(user_id, city)
+        return
+    try:
+        await redis_client.set(_user_city_key(user_id), city, ex=USER_CITY_TTL)
     except Exception as e:
-        print(f"Ошибка при запросе к API: {e}")
-        return []
+        logger.error("Redis недоступен: %s", e)
+
+
+async def _cached_user_city(user_id: int):
+    if redis_client is not None:
+        try:
+            city = await redis_client.get(_user_city_key(user_id))
+        except Exception as e:
+            logger.error("Redis недоступен: %s", e)
+            return None
+        return city.decode() if city is not None else None
+
+    entry = user_cities.get(user_id)
+    if entry is None:
+        return None
+    city, expires_at = entry
+    if expires_at < time.monotonic():
+        del user_cities[user_id]
+        return None
+    user_cities.move_to_end(user_id)
+    return city
+
+
+async def get_user_city(user_id: int) -> str:
+    city = await _cached_user_city(user_id)
+    if city in CITIES:
+        return city
+
+    city = None
+    if pool is not None:
+        city = await db_fetchval('get_user_city', user_id)
+    if city not in CITIES:
+        city = DEFAULT_CITY
+    await _remember_city(user_id, city)
+    return city
+
+
+async def set_user_city(user_id: int, city: str):
+    if pool is not None:
+        await db_fetch('set_user_city', user_id, city)
+    await _remember_city(user_id, city)
+
+
+# Кэш file_id картинок событий: URL -> file_id, выданный Telegram при первой отправке
+image_file_ids = OrderedDict()
+
+
+async def get_image_file_id(image_url: str):
+    file_id = image_file_ids.get(image_url)
+    if file_id is not None:
+        image_file_ids.move_to_end(image_url)
+        return file_id
+
+    if pool is None:
+        return None
+    file_id = await db_fetchval('get_event_image', image_url)
+    if file_id is not None:
+        _remember_image_locally(image_url, file_id)
+    return file_id
+
+
+def _remember_image_locally(image_url: str, file_id: str):
+    image_file_ids[image_url] = file_id
+    image_file_ids.move_to_end(image_url)
+    while len(image_file_ids) > IMAGE_FILE_ID_CACHE_SIZE:
+        image_file_ids.popitem(last=False)
+
+
+async def save_image_file_id(image_url: str, file_id: str):
+    _remember_image_locally(image_url, file_id)
+
+    if pool is None:
+        return
+    await db_fetch('save_event_image', image_url, file_id)
+
+
+async def forget_image_file_id(image_url: str):
+    image_file_ids.pop(image_url, None)
+
+    if pool is None:
+        return
+    await db_fetch('delete_event_image', image_url)
+
+
+# Показ карточки (события или воспоминания) с редактированием уже отправленного сообщения
+async def render_card(chat_id: int, text: str, reply_markup, photo=None, message: Message = None):
+    """Редактирует message на месте, а если сменился тип (фото/текст) — отправляет заново.
+
+    Каждая отрисовка получает новую версию карточки чата: если пользователь успел
+    перейти дальше, пока запрос ждал лимита, он отбрасывается (CardUpdateSuperseded).
+    """
+    token = outbound_limiter.begin_card(chat_id)
+    try:
+        return await _render_card(chat_id, text, reply_markup, photo, message)
+    finally:
+        card_update.reset(token)
+
+
+async def _render_card(chat_id: int, text: str, reply_markup, photo=None, message: Message = None):
+    if message is not None:
+        try:
+            result = None
+            if photo is not None and getattr(message, 'photo', None):
+                result = await bot.edit_message_media(
+                    chat_id=chat_id,
+                    message_id=message.message_id,
+                    media=InputMediaPhoto(media=photo, caption=text, parse_mode='HTML'),
+                    reply_markup=reply_markup
+                )
+            elif photo is None and getattr(message, 'text', None) is not None:
+                result = await bot.edit_message_text(
+                    chat_id=chat_id,
+                    message_id=message.message_id,
+                    text=text,
+                    reply_markup=reply_markup,
+                    parse_mode='HTML'
+                )
+            if result is not None:
+                return result if isinstance(result, Message) else message
+        except TelegramBadRequest as e:
+            if 'message is not modified' in str(e):
+                return message
+            raise
+
+    # Новое сообщение отправляем до удаления старого, чтобы при ошибке карточка не пропала
+    if photo is not None:
+        sent_message = await bot.send_photo(
+            chat_id=chat_id,
+            photo=photo,
+            caption=text,
+            reply_markup=reply_markup,
+            parse_mode='HTML'
+        )
+    else:
+        sent_message = await bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            reply_markup=reply_markup,
+            parse_mode='HTML'
+        )
+
+    if message is not None:
+        try:
+            await bot.delete_message(chat_id=chat_id, message_id=message.message_id)
+        except TelegramBadRequest:
+            pass
+    return sent_message
+
+
+# Предзагрузка картинок следующих событий, пока пользователь смотрит текущее
+class ImagePrefetcher:
+    """Фоновая подготовка картинок: сохраненный file_id, file_id через служебный чат или байты в памяти.
+
+    Байты скачиваются, только если включено download, и вместе с идущими загрузками
+    занимают не больше byte_budget.
+    """
+
+    def __init__(self, concurrency: int, byte_budget: int, cache_chat_id: int = None, download: bool = False):
+        self.byte_budget = byte_budget
+        self.cache_chat_id = cache_chat_id
+        self.download = download
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._content = OrderedDict()  # url -> bytes
+        self._content_size = 0
+        self._reserved = 0  # место в бюджете под идущие скачивания
+        self._tasks = {}  # url -> задача предзагрузки
+        self._wanted_by = {}  # url -> id пользователей, которым нужна картинка
+        self._user_urls = {}  # user_id -> url, запрошенные пользователем
+
+    def schedule(self, user_id: int, urls: list):
+        """Заменяет окно предзагрузки пользователя: отменяются только картинки, вышедшие из окна"""
+        wanted = {url for url in urls if url and url not in self._content and url not in image_file_ids}
+        for url in self._user_urls.pop(user_id, set()) - wanted:
+            self._release(url, user_id)
+        if wanted:
+            self._user_urls[user_id] = wanted
+        for url in wanted:
+            self._wanted_by.setdefault(url, set()).add(user_id)
+            if url not in self._tasks:
+                task = asyncio.create_task(self._prefetch(url))
+                self._tasks[url] = task
+                task.add_done_callback(lambda task, url=url: self._forget(url, task))
+
+    def cancel(self, user_id: int):
+        for url in self._user_urls.pop(user_id, ()):
+            self._release(url, user_id)
+
+    def _release(self, url: str, user_id: int):
+        # Задача отменяется, только когда картинка больше никому не нужна
+        wanted_by = self._wanted_by.get(url)
+        if wanted_by is None:
+            return
+        wanted_by.discard(user_id)
+        if not wanted_by:
+            del self._wanted_by[url]
+            task = self._tasks.pop(url, None)
+            if task is not None:
+                task.cancel()
+
+    def cancel_all(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    async def warm(self, url: str):
+        """Готовит картинку вне пользовательской сессии (прогрев кэша)"""
+        if url not in self._content and url not in self._tasks:
+            await self._prefetch(url)
+
+    def _forget(self, url: str, task: asyncio.Task):
+        # Отмененную задачу могла уже сменить новая для того же url
+        if self._tasks.get(url) is not task:
+            return
+        del self._tasks[url]
+        for user_id in self._wanted_by.pop(url, ()):
+            user_urls = self._user_urls.get(user_id)
+            if user_urls is not None:
+                user_urls.discard(url)
+                if not user_urls:
+                    del self._user_urls[user_id]
+
+    def take(self, url: str):
+        """Забирает скачанные байты: после отправки картинка будет доступна по file_id"""
+        content = self._content.pop(url, None)
+        if content is not None:
+            self._content_size -= len(content)
+        return content
+
+    def _evict(self):
+        while self._content and self._content_size + self._reserved > self.byte_budget:
+            _, evicted = self._content.popitem(last=False)
+            self._content_size -= len(evicted)
+
+    async def _download(self, url: str):
+        # Место занимается до скачивания: идущие загрузки вместе с сохраненными не превышают бюджет
+        item_limit = self.byte_budget // 4
+        self._reserved += item_limit
+        try:
+            self._evict()
+            if self._content_size + self._reserved > self.byte_budget:
+                return
+            content = await kudago.get_bytes(url, max_size=item_limit)
+        finally:
+            self._reserved -= item_limit
+        if content is not None:
+            self._content[url] = content
+            self._content_size += len(content)
+            self._evict()
+
+    async def _prefetch(self, url: str):
+        async with self._semaphore:
+            try:
+                if await get_image_file_id(url) is not None:
+                    return
+                if self.cache_chat_id is not None:
+                    # Загрузка в служебный чат дает file_id, и пользователю картинка уйдет одним запросом
+                    warm_message = await bot.send_photo(
+                        chat_id=self.cache_chat_id, photo=url, disable_notification=True
+                    )
+                    await save_image_file_id(url, warm_message.photo[-1].file_id)
+                    await bot.delete_message(chat_id=self.cache_chat_id, message_id=warm_message.message_id)
+                    return
+                if self.download:
+                    await self._download(url)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.debug("Не удалось предзагрузить %s: %s", url, e)
+
+
+image_prefetcher = ImagePrefetcher(
+    IMAGE_PREFETCH_CONCURRENCY, IMAGE_PREFETCH_BUDGET, IMAGE_CACHE_CHAT_ID, download=IMAGE_PREFETCH_BYTES
+)
+
+
+# Отправка картинки события: сначала по file_id, затем по URL, в крайнем случае загрузкой файла
+async def send_event_photo(chat_id: int, image_url: str, caption: str, reply_markup, message: Message = None):
+    file_id = await get_image_file_id(image_url)
+    if file_id is not None:
+        try:
+            return await render_card(chat_id, caption, reply_markup, photo=file_id, message=message)
+        except TelegramBadRequest as e:
+            logger.error("file_id для %s больше не действителен: %s", image_url, e)
+            await forget_image_file_id(image_url)
+
+    # Картинка уже скачана заранее: загружаем ее сами, не дожидаясь, пока Telegram сходит за ней на CDN
+    content = image_prefetcher.take(image_url)
+    try:
+        if content is not None:
+            photo = types.BufferedInputFile(content, filename="event.jpg")
+        else:
+            # Telegram сам скачает картинку по ссылке, бот не передает ни байта
+            photo = image_url
+        sent_message = await render_card(chat_id, caption, reply_markup, photo=photo, message=message)
+    except TelegramBadRequest as e:
+        logger.debug("Telegram не смог загрузить %s по ссылке: %s", image_url, e)
+        content = await kudago.get_bytes(image_url)
+        if content is None:
+            raise
+        sent_message = await render_card(
+            chat_id,
+            caption,
+            reply_markup,
+            photo=types.BufferedInputFile(content, filename="event.jpg"),
+            message=message
+        )
+
+    if sent_message.photo:
+        await save_image_file_id(image_url, sent_message.photo[-1].file_id)
+    return sent_message
 
 
 # Отображение карточки события
-async def show_event_card(chat_id: int, events: list, index: int):
+async def show_event_card(chat_id: int, events: list, index: int, message: Message = None, has_more: bool = False):
     try:
         if index < 0 or index >= len(events):
             raise IndexError("Invalid event index")
 
         event = events[index]
-        print(f"[DEBUG] Event structure: {event}")  # Для отладки
+        logger.debug("Event card: %s", event)
 
-        # Формирование текста
-        title = event.get('title', 'Без названия')
-        
-        # Обработка места
-        place_data = event.get('place', {})
-        if isinstance(place_data, dict):
-            place_name = place_data.get('name', '')
-            address = place_data.get('address', '')
-            place_text = f"{place_name}, {address}" if place_name else address
-        else:
-            place_text = str(place_data) if place_data else 'Место не указано'
-        
-        # Обработка цены
-        price_data = event.get('price', '')
-        if isinstance(price_data, dict):
-            price_text = price_data.get('name', 'Цена не указана')
-        else:
-            price_text = str(price_data) if price_data else 'Цена не указана'
-
-        url = event.get('site_url', 'https://kudago.com')
-        
-        text = (
-            f"🎟 <b>{title}</b>\n\n"
-            f"📍 <b>Место:</b> {place_text if place_text else 'Адрес не указан'}\n"
-            f"💰 <b>Цена:</b> {price_text}\n"
-            f"🌐 <b>Сайт:</b> <a href='{url}'>Подробнее</a>"
+        # Пока пользователь читает карточку, готовим картинки следующих
+        image_prefetcher.schedule(
+            chat_id,
+            [e.image_url for e in events[index + 1:index + 1 + IMAGE_PREFETCH_AHEAD]]
         )
 
-        # Обработка изображения
-        image_url = None
-        images = event.get('images', [])
-        if images and isinstance(images, list):
-            first_image = images[0]
-            if isinstance(first_image, dict):
-                image_url = first_image.get('image')
-
         # Клавиатура
         builder = InlineKeyboardBuilder()
         if index > 0:
             builder.button(text="◀ Назад", callback_data=f"event_prev_{index}")
-        if index < len(events) - 1:
+        if index < len(events) - 1 or has_more:
             builder.button(text="Дальше ▶", callback_data=f"event_next_{index}")
         builder.button(text="🏠 Меню", callback_data="main_menu")
         builder.adjust(2)
 
         # Отправка сообщения
-        if image_url:
+        if event.image_url:
             try:
-                # Скачиваем изображение и отправляем как файл
-                response = requests.get(image_url)
-                if response.status_code == 200:
-                    photo = types.BufferedInputFile(response.content, filename="event.jpg")
-                    await bot.send_photo(
-                        chat_id=chat_id,
-                        photo=photo,
-                        caption=text,
-                        reply_markup=builder.as_markup(),
-                        parse_mode='HTML'
-                    )
-                    return
+                return await send_event_photo(chat_id, event.image_url, event.caption, builder.as_markup(), message)
+            except CardUpdateSuperseded:
+                raise
             except Exception as e:
-                print(f"[ERROR] Failed to send photo: {e}")
+                logger.error("Failed to send photo: %s", e, extra={'chat_id': chat_id})
 
-        # Если изображение не удалось отправить, отправляем текст
-        await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            reply_markup=builder.as_markup(),
-            parse_mode='HTML'
-        )
+        # Если изображение не удалось отправить, показываем текст
+        return await render_card(chat_id, event.caption, builder.as_markup(), message=message)
 
+    except CardUpdateSuperseded:
+        raise
     except Exception as e:
-        print(f"[ERROR] Failed to show event card: {e}")
+        logger.exception("Failed to show event card", extra={'chat_id': chat_id})
         await bot.send_message(
             chat_id=chat_id,
             text="⚠ Произошла ошибка при загрузке информации о мероприятии",
@@ -321,7 +1770,7 @@ async def back_to_interests_handler(callback: CallbackQuery):
             reply_markup=builder.as_markup()
         )
     except Exception as e:
-        print(f"Ошибка при редактировании сообщения: {e}")
+        logger.warning("Ошибка при редактировании сообщения: %s", e)
         # Если не получилось отредактировать, отправляем новое
         await callback.message.answer(
             "Что вас интересует?",
@@ -332,15 +1781,16 @@ async def back_to_interests_handler(callback: CallbackQuery):
 # Обработчик выбора даты
 @dp.callback_query(F.data.startswith("date_"))
 async def handle_date_selection(callback: CallbackQuery,  state: FSMContext):
-    print("[DEBUG] Вызван handle_date_selection")
+    logger.debug("Вызван handle_date_selection")
     data = callback.data.split("_")
     date_type = data[1]
     category = data[2]
 
+    city = await get_user_city(callback.from_user.id)
     if date_type == 'today':
-        events = await get_events(category, 'today')
+        events, has_more = await get_events(category, 'today', city)
     elif date_type == 'tomorrow':
-        events = await get_events(category, 'tomorrow')
+        events, has_more = await get_events(category, 'tomorrow', city)
     elif date_type == 'custom':
         await state.update_data(category=category)
         await callback.message.answer("Введите дату в формате ДД.ММ.ГГГГ")
@@ -352,10 +1802,10 @@ async def handle_date_selection(callback: CallbackQuery,  state: FSMContext):
         return
 
     user_id = callback.from_user.id
-    events_cache[user_id] = events
-    print(f"[DEBUG] Saved {len(events)} events to cache for user {user_id}")
-    current_event_index[user_id] = 0
-    await show_event_card(user_id, events, 0)
+    # В сессии только параметры запроса: сами события лежат в общем кэше
+    await sessions.set('events', user_id, {'category': category, 'date': date_type, 'city': city, 'index': 0})
+    logger.debug("Started events session (%d events)", len(events), extra={'user_id': user_id})
+    await show_event_card(user_id, events, 0, has_more=has_more)
 
     await callback.message.delete()
 
@@ -381,7 +1831,8 @@ async def process_custom_date(message: Message, state: FSMContext):
         category = data.get('category')
 
         # Получаем события для введенной даты
-        events = await get_events(category, date_str)  # Передаем строку с датой
+        city = await get_user_city(message.from_user.id)
+        events, has_more = await get_events(category, date_str, city)  # Передаем строку с датой
 
         if not events:
             await message.answer("На выбранную дату мероприятий не найдено 😢")
@@ -389,10 +1840,8 @@ async def process_custom_date(message: Message, state: FSMContext):
             return
 
         user_id = message.from_user.id
-        events_cache[user_id] = events
-        
-        current_event_index[user_id] = 0
-        await show_event_card(user_id, events, 0)
+        await sessions.set('events', user_id, {'category': category, 'date': date_str, 'city': city, 'index': 0})
+        await show_event_card(user_id, events, 0, has_more=has_more)
         await state.clear()
 
 
@@ -408,20 +1857,42 @@ async def handle_event_navigation(callback: CallbackQuery):
     current_index = int(data[2])
     user_id = callback.from_user.id
 
-    # Получаем события из "кэша" (в реальном проекте нужно реализовать кэширование)
-    events = await get_events_from_cache(user_id)
-    if not events:
+    session = await sessions.get('events', user_id)
+    if not session:
         await callback.answer("Мероприятия не найдены")
         return
+    # Кнопка со старой карточки или повторное нажатие: карточка уже показана
+    if session['index'] != current_index:
+        await callback.answer()
+        return
 
     if direction == 'prev':
         new_index = current_index - 1
     else:
         new_index = current_index + 1
+    if new_index < 0:
+        await callback.answer()
+        return
 
-    current_event_index[user_id] = new_index
-    await callback.message.delete()
-    await show_event_card(user_id, events, new_index)
+    # Получаем события по параметрам из сессии через общий кэш;
+    # следующая страница подгружается, когда пользователь подходит к концу загруженных
+    events, has_more = await get_events(
+        session['category'],
+        session['date'],
+        session.get('city', DEFAULT_CITY),
+        need=new_index + 1 + EVENTS_LOOKAHEAD
+    )
+    if not events:
+        await callback.answer("Мероприятия не найдены")
+        return
+    if new_index >= len(events):
+        await callback.answer("Это последнее мероприятие")
+        return
+
+    session['index'] = new_index
+    await sessions.set('events', user_id, session)
+    await show_event_card(user_id, events, new_index, callback.message, has_more=has_more)
+    await callback.answer()
 
 
 # Обработчик кнопки "На память"
@@ -571,6 +2042,301 @@ async def process_memory_description(message: Message, state: FSMContext):
     await state.set_state(MemoryStates.waiting_for_photo)
 
 
+# Хранилища фото воспоминаний. Файлы адресуются хэшем содержимого,
+# поэтому одинаковые фото хранятся один раз, а имена не конфликтуют
+def photo_key(content: bytes) -> str:
+    digest = hashlib.sha256(content).hexdigest()
+    return f"{digest[:2]}/{digest}.jpg"
+
+
+class LocalPhotoStore:
+    """Фото в локальном каталоге; photo_path — путь к файлу"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def _write(self, path: str, content: bytes):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Пишем в уникальный временный файл и переименовываем, чтобы не оставить недописанный файл
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            os.replace(tmp_path, path)
+        except OSError:
+            # Тот же файл успел записать параллельный вызов: по ключу содержимое совпадает
+            if not os.path.exists(path):
+                raise
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    async def save(self, content: bytes) -> str:
+        path = os.path.join(self.root, photo_key(content))
+        await asyncio.to_thread(self._write, path, content)
+        return path
+
+    def _read(self, path: str):
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    async def load(self, path: str):
+        return await asyncio.to_thread(self._read, path)
+
+
+class S3PhotoStore:
+    """Фото в S3-совместимом хранилище (в том числе MinIO); photo_path — s3://bucket/key"""
+
+    def __init__(self, bucket: str, endpoint_url: str = None, access_key: str = None,
+                 secret_key: str = None, region: str = None):
+        import boto3  # нужен только при PHOTO_STORE=s3
+
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            region_name=region
+        )
+
+    def _write(self, key: str, content: bytes):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=key)
+            return
+        except self.client.exceptions.ClientError:
+            pass
+        self.client.put_object(Bucket=self.bucket, Key=key, Body=content, ContentType='image/jpeg')
+
+    async def save(self, content: bytes) -> str:
+        key = photo_key(content)
+        await asyncio.to_thread(self._write, key, content)
+        return f"s3://{self.bucket}/{key}"
+
+    def _read(self, key: str):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.client.exceptions.ClientError:
+            return None
+
+    async def load(self, path: str):
+        key = path.removeprefix(f"s3://{self.bucket}/")
+        return await asyncio.to_thread(self._read, key)
+
+
+if PHOTO_STORE == 's3':
+    photo_store = S3PhotoStore(S3_BUCKET, S3_ENDPOINT_URL, S3_ACCESS_KEY, S3_SECRET_KEY, S3_REGION)
+else:
+    photo_store = LocalPhotoStore(PHOTO_DIR)
+local_photo_store = LocalPhotoStore(PHOTO_DIR)
+
+
+# Чтение фото по photo_path: старые записи и local-хранилище лежат на диске, s3 — в бакете
+async def load_memory_photo(photo_path: str):
+    if photo_path.startswith('s3://'):
+        if not isinstance(photo_store, S3PhotoStore):
+            return None
+        return await photo_store.load(photo_path)
+    return await local_photo_store.load(photo_path)
+
+
+# Фоновые задачи, которые не должны задерживать ответ пользователю
+background_tasks = set()
+
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+
+# Скачивание фото из Telegram и сохранение в хранилище уже после ответа пользователю
+async def store_memory_photo(user_id: int, file_id: str, inserted: asyncio.Future):
+    try:
+        buffer = BytesIO()
+        await bot.download(file_id, destination=buffer)
+        photo_path = await photo_store.save(buffer.getvalue())
+
+        # Запись воспоминания могла еще не дойти до БД
+        await inserted
+        await db_fetch('set_memory_photo_path', photo_path, user_id, file_id)
+        await memory_history_cache.invalidate(user_id)
+    except Exception:
+        logger.exception("Не удалось сохранить фото воспоминания", extra={'user_id': user_id})
+
+
+# Приращения сводок статистики по пачке записей (user_id, date, place, rating, ...)
+def memory_stats_deltas(records: list) -> tuple:
+    monthly = {}
+    places = {}
+    for user_id, day, place, rating, *_ in records:
+        targets = [monthly.setdefault((user_id, day.replace(day=1)), [0, 0, 0])]
+        place = (place or '').strip(STATS_PLACE_TRIM)[:STATS_PLACE_MAX_LENGTH]
+        if place:
+            targets.append(places.setdefault((user_id, place), [0, 0, 0]))
+        for counters in targets:
+            counters[0] += 1
+            if rating is not None:
+                counters[1] += 1
+                counters[2] += rating
+    return (
+        [(*key, *counters) for key, counters in monthly.items()],
+        [(*key, *counters) for key, counters in places.items()],
+    )
+
+
+# Отложенная пакетная запись воспоминаний
+class MemoryWriter:
+    """Очередь вставок в memories: копит записи до MEMORY_WRITE_INTERVAL и пишет их одним executemany"""
+
+    def __init__(self, batch_size: int, flush_interval: float, max_queue: int, retries: int = 3,
+                 max_backoff: float = 30):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries  # попыток записать пачку целиком, прежде чем писать записи по одной
+        self.max_backoff = max_backoff
+        # Ограниченная очередь: при переполнении обработчики ждут, а не копят память
+        self._queue = asyncio.Queue(max_queue)
+        self._task = None
+        self._closing = asyncio.Event()
+        self._flushed = deque(maxlen=1000)  # (время, число записей) последних пачек
+        self.inserted = 0
+        self.failed = 0
+        self.batches = 0
+
+    def start(self):
+        self._closing = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def submit(self, record: tuple) -> asyncio.Future:
+        """Ставит запись в очередь; future завершится, когда запись будет в БД"""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((record, future))
+        return future
+
+    async def _next_batch(self) -> list:
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._next_batch()
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: list):
+        if len(batch) > 1:
+            if await self._write(batch, self.retries) is None:
+                return
+            # Пачка так и не записалась: по одной записи плохая строка теряет только себя
+            logger.warning("Пачка из %d воспоминаний не записалась, пишем по одной", len(batch))
+        for record, future in batch:
+            error = await self._write([(record, future)])
+            if error is not None:
+                self.failed += 1
+                logger.error("Потеряна запись воспоминания %s: %s", record, error)
+                if not future.done():
+                    future.set_exception(error)
+
+    async def _write(self, batch: list, attempts: int = None):
+        """Пишет записи одной транзакцией; возвращает последнюю ошибку, если записать не удалось.
+
+        Сбои соединения повторяются с растущей паузой до attempts раз, а без attempts — пока бот
+        не начал останавливаться. Ошибку в самих данных повторять бессмысленно.
+        """
+        records = [record for record, _ in batch]
+        monthly, places = memory_stats_deltas(records)
+        for attempt in itertools.count(1):
+            try:
+                # Сводки статистики меняются в той же транзакции, что и вставка
+                await db_executemany_atomic([
+                    ('insert_memory', records),
+                    ('add_memory_stats_monthly', monthly),
+                    ('add_memory_stats_places', places),
+                ])
+                break
+            except Exception as e:
+                logger.error("Не удалось записать %d воспоминаний (попытка %d): %s", len(records), attempt, e)
+                bad_data = isinstance(e, (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError))
+                if bad_data or self._closing.is_set() or (attempts is not None and attempt >= attempts):
+                    return e
+                await self._backoff(attempt)
+
+        self.inserted += len(records)
+        self.batches += 1
+        self._flushed.append((time.monotonic(), len(records)))
+        for _, future in batch:
+            if not future.done():
+                future.set_result(None)
+        return None
+
+    async def _backoff(self, attempt: int):
+        # Остановка бота прерывает паузу: оставшиеся записи получают последнюю попытку
+        try:
+            await asyncio.wait_for(self._closing.wait(), min(self.max_backoff, 0.5 * (2 ** (attempt - 1))))
+        except asyncio.TimeoutError:
+            pass
+
+    @property
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def inserts_per_second(self, window: float = 60) -> float:
+        since = time.monotonic() - window
+        return sum(count for flushed_at, count in self._flushed if flushed_at >= since) / window
+
+    async def close(self):
+        """Дописывает все, что осталось в очереди, и останавливает запись"""
+        if self._task is None:
+            return
+        self._closing.set()
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+memory_writer = MemoryWriter(
+    MEMORY_WRITE_BATCH, MEMORY_WRITE_INTERVAL, MEMORY_WRITE_QUEUE, max_backoff=MEMORY_WRITE_BACKOFF_MAX
+)
+
+
+# Дата в данных состояния хранится строкой ДД.ММ.ГГГГ, в БД пишется как DATE
+def parse_memory_date(value: str) -> date_class:
+    return datetime.strptime(value, "%d.%m.%Y").date()
+
+
+# Кэш истории сбрасывается, когда запись действительно появилась в БД: раньше его заполнили бы старые данные
+def invalidate_history_on_insert(user_id: int, inserted: asyncio.Future):
+    def invalidate(future: asyncio.Future):
+        # Запись не дошла до БД: сбрасывать нечего, а ошибку MemoryWriter уже записал в лог
+        if future.cancelled() or future.exception() is not None:
+            return
+        run_in_background(memory_history_cache.invalidate(user_id))
+
+    inserted.add_done_callback(invalidate)
+
+
 @dp.message(MemoryStates.waiting_for_photo)
 async def process_memory_photo(message: Message, state: FSMContext):
     global pool
@@ -590,25 +2356,21 @@ async def process_memory_photo(message: Message, state: FSMContext):
         await message.answer("📸 Пожалуйста, прикрепите фото или нажмите 'Пропустить'")
         return
 
+    # Показывать фото можно сразу по file_id, копия файла сохраняется в фоне
     photo = message.photo[-1]
-    photo_file = await bot.get_file(photo.file_id)
-    photo_path = f"photos/{message.from_user.id}_{int(time.time())}.jpg"
 
-    os.makedirs("photos", exist_ok=True)
-    await bot.download_file(photo_file.file_path, photo_path)
+    # Запись уходит в очередь, пользователь не ждет коммита
+    inserted = await memory_writer.submit((
+        message.from_user.id,
+        parse_memory_date(data.get('date')),
+        data.get('place'),
+        data.get('rating'),
+        data.get('description'),
+        photo.file_id
+    ))
+    invalidate_history_on_insert(message.from_user.id, inserted)
 
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """INSERT INTO memories 
-            (user_id, date, place, rating, description, photo_path) 
-            VALUES ($1, $2, $3, $4, $5, $6)""",
-            message.from_user.id,
-            data.get('date'),
-            data.get('place'),
-            data.get('rating'),
-            data.get('description'),
-            photo_path
-        )
+    run_in_background(store_memory_photo(message.from_user.id, photo.file_id, inserted))
 
     await message.answer("✅ Воспоминание успешно сохранено с фото!")
     await state.clear()
@@ -628,17 +2390,15 @@ async def skip_photo(callback: CallbackQuery, state: FSMContext):
     except:
         pass
 
-    async with pool.acquire() as conn:
-        await conn.execute(
-            """INSERT INTO memories 
-            (user_id, date, place, rating, description) 
-            VALUES ($1, $2, $3, $4, $5)""",
-            callback.from_user.id,
-            data.get('date'),
-            data.get('place'),
-            data.get('rating'),
-            data.get('description')
-        )
+    inserted = await memory_writer.submit((
+        callback.from_user.id,
+        parse_memory_date(data.get('date')),
+        data.get('place'),
+        data.get('rating'),
+        data.get('description'),
+        None
+    ))
+    invalidate_history_on_insert(callback.from_user.id, inserted)
 
     await callback.message.answer("✅ Воспоминание сохранено без фото!")
     await state.clear()
@@ -677,39 +2437,152 @@ async def show_history_periods(message: Message, state: FSMContext):
     
 
 
-# Получение воспоминаний из БД (теперь без параметра pool)
-async def get_memories(user_id: int, period: str = None, start_date: str = None, end_date: str = None):
-    global pool
+# Период истории по кнопке "Неделя"/"Месяц"
+def history_period_range(period: str):
+    end_date = datetime.now().date()
+    if period == 'week':
+        return end_date - timedelta(days=7), end_date
+    return end_date - timedelta(days=30), end_date
+
+
+# Кэш истории воспоминаний: страницы из БД и готовые карточки, отдельно по каждому пользователю
+class MemoryHistoryCache:
+    """Записи пользователя действительны, пока не сменилась его версия (новое воспоминание, новое фото),
+    и не дольше ttl секунд.
+
+    С Redis версия общая для всех процессов бота: изменение в одном процессе сбрасывает кэш в остальных.
+    """
+
+    def __init__(self, max_users: int, max_entries: int, ttl: int, redis_client=None):
+        self.max_users = max_users
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.redis = redis_client
+        self._users = OrderedDict()  # user_id -> (версия, срок жизни, OrderedDict ключ -> значение)
+        self._versions = OrderedDict()  # user_id -> текущая версия, если Redis не настроен
+        self._next_version = itertools.count(1)
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _version_key(user_id: int) -> str:
+        return f"memcache:version:{user_id}"
+
+    async def version(self, user_id: int):
+        """Текущая версия истории пользователя; None, если ее не узнать, и кэш тогда не используется"""
+        if self.redis is None:
+            return self._versions.get(user_id, 0)
+        try:
+            raw = await self.redis.get(self._version_key(user_id))
+        except Exception as e:
+            logger.error("Redis недоступен: %s", e)
+            return None
+        return int(raw) if raw is not None else 0
+
+    def get(self, user_id: int, key, version):
+        entry = self._users.get(user_id)
+        if entry is not None and entry[1] < time.monotonic():
+            del self._users[user_id]
+            entry = None
+        if version is not None and entry is not None and entry[0] == version:
+            value = entry[2].get(key)
+            if value is not None:
+                self._users.move_to_end(user_id)
+                entry[2].move_to_end(key)
+                self.hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, user_id: int, key, value, version):
+        """Сохраняет значение, прочитанное при версии version; если с тех пор были изменения, оно отбрасывается"""
+        if version is None or (self.redis is None and version != self._versions.get(user_id, 0)):
+            return
+        entry = self._users.get(user_id)
+        if entry is None or entry[0] != version or entry[1] < time.monotonic():
+            entry = (version, time.monotonic() + self.ttl, OrderedDict())
+        self._users[user_id] = entry
+        self._users.move_to_end(user_id)
+        entry[2][key] = value
+        entry[2].move_to_end(key)
+        while len(entry[2]) > self.max_entries:
+            entry[2].popitem(last=False)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+
+    async def invalidate(self, user_id: int):
+        self._users.pop(user_id, None)
+        self.invalidations += 1
+        if self.redis is None:
+            self._versions[user_id] = next(self._next_version)
+            self._versions.move_to_end(user_id)
+            while len(self._versions) > self.max_users:
+                self._versions.popitem(last=False)
+            return
+        # Версия не повторяется и после истечения ключа: устаревшая запись не совпадет с новой версией.
+        # Ключ живет дольше любой записи кэша
+        try:
+            await self.redis.set(self._version_key(user_id), time.time_ns(), ex=max(self.ttl * 2, 86400))
+        except Exception as e:
+            logger.error("Redis недоступен: %s", e)
 
-    query = "SELECT * FROM memories WHERE user_id = $1"
-    params = [user_id]
 
-    if period == 'week':
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=7)
-        query += " AND TO_DATE(date, 'DD.MM.YYYY') BETWEEN $2 AND $3"
-        params.extend([start_date, end_date])
-    elif period == 'month':
-        end_date = datetime.now().date()
-        start_date = end_date - timedelta(days=30)
-        query += " AND TO_DATE(date, 'DD.MM.YYYY') BETWEEN $2 AND $3"
-        params.extend([start_date, end_date])
-    elif start_date and end_date:
-        query += " AND TO_DATE(date, 'DD.MM.YYYY') BETWEEN $2 AND $3"
-        params.extend([start_date, end_date])
+memory_history_cache = MemoryHistoryCache(MEMORY_CACHE_USERS, MEMORY_CACHE_ENTRIES, MEMORY_CACHE_TTL, redis_client)
 
-    query += " ORDER BY TO_DATE(date, 'DD.MM.YYYY') DESC"
 
-    async with pool.acquire() as conn:
-        return await conn.fetch(query, *params)
+# Получение страницы воспоминаний за период: постраничный проход по (date, id) от курсора
+async def get_memories(user_id: int, start_date: date_class, end_date: date_class,
+                       cursor: tuple = None, direction: str = 'next', limit: int = 1):
+    """Воспоминания от новых к старым; direction='prev' возвращает более новые, ближайшее первым"""
+    key = ('page', start_date, end_date, cursor, direction, limit)
+    version = await memory_history_cache.version(user_id)
+    memories = memory_history_cache.get(user_id, key, version)
+    if memories is not None:
+        return memories
 
+    if cursor is None:
+        memories = await db_fetch('memories_first', user_id, start_date, end_date, limit)
+    else:
+        name = 'memories_older' if direction == 'next' else 'memories_newer'
+        memories = await db_fetch(name, user_id, start_date, end_date, cursor[0], cursor[1], limit)
+    memories = tuple(memories)
+    memory_history_cache.put(user_id, key, memories, version)
+    return memories
 
-# Отображение карточки воспоминания
-async def show_memory_card(chat_id: int, memories: list, index: int, last_message_id: int = None):
-    memory = memories[index]
 
+# Курсор воспоминания для callback_data: ГГГГММДД_id
+def memory_cursor(memory) -> str:
+    return f"{memory['date']:%Y%m%d}_{memory['id']}"
+
+
+def parse_memory_cursor(value: str) -> tuple:
+    day, memory_id = value.split("_")
+    return datetime.strptime(day, "%Y%m%d").date(), int(memory_id)
+
+
+# Предзагруженные воспоминания хранятся в сессии в виде JSON
+def memory_to_session(memory) -> dict:
+    data = dict(memory)
+    data['date'] = data['date'].isoformat()
+    return data
+
+
+def memory_from_session(data: dict) -> dict:
+    memory = dict(data)
+    memory['date'] = date_class.fromisoformat(memory['date'])
+    return memory
+
+
+# Сохранение file_id после загрузки фото воспоминания с диска
+async def save_memory_photo_file_id(memory_id: int, file_id: str):
+    await db_fetch('set_memory_photo_file_id', file_id, memory_id)
+
+
+# Текст и клавиатура карточки воспоминания
+def render_memory_card(memory, has_prev: bool, has_next: bool) -> tuple:
     text = (
-        f"📅 <b>Дата:</b> {memory['date']}\n"
+        f"📅 <b>Дата:</b> {memory['date'].strftime('%d.%m.%Y')}\n"
         f"📍 <b>Место:</b> {memory['place'] or 'Не указано'}\n"
         f"⭐ <b>Оценка:</b> {memory['rating'] or 'Не указана'}\n"
         f"📝 <b>Описание:</b> {memory['description'] or 'Не указано'}"
@@ -717,35 +2590,53 @@ async def show_memory_card(chat_id: int, memories: list, index: int, last_messag
 
     # Клавиатура
     builder = InlineKeyboardBuilder()
-    if index > 0:
-        builder.button(text="Назад", callback_data=f"memory_prev_{index}")
-    if index < len(memories) - 1:
-        builder.button(text="Дальше", callback_data=f"memory_next_{index}")
+    if has_prev:
+        builder.button(text="Назад", callback_data=f"memory_prev_{memory_cursor(memory)}")
+    if has_next:
+        builder.button(text="Дальше", callback_data=f"memory_next_{memory_cursor(memory)}")
     builder.button(text="Меню", callback_data="memory_to_menu")
-
-    if last_message_id:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=last_message_id)
-        except:
-            pass
+    return text, builder.as_markup()
 
 
-    # Отправка сообщения
-    if memory['photo_path'] and os.path.exists(memory['photo_path']):
-        sent_message = await bot.send_photo(
-            chat_id=chat_id,
-            photo=FSInputFile(memory['photo_path']),
-            caption=text,
-            reply_markup=builder.as_markup(),
-            parse_mode='HTML'
-        )
-    else:
-        sent_message = await bot.send_message(
-            chat_id=chat_id,
-            text=text,
-            reply_markup=builder.as_markup(),
-            parse_mode='HTML'
+# Отображение карточки воспоминания
+async def show_memory_card(chat_id: int, memory, has_prev: bool, has_next: bool, message: Message = None):
+    # Подпись и клавиатура собираются один раз на версию истории пользователя
+    key = ('card', memory['id'], has_prev, has_next)
+    version = await memory_history_cache.version(chat_id)
+    rendered = memory_history_cache.get(chat_id, key, version)
+    if rendered is None:
+        rendered = render_memory_card(memory, has_prev, has_next)
+        memory_history_cache.put(chat_id, key, rendered, version)
+    text, markup = rendered
+
+    # Отправка сообщения: сначала по file_id, файл с диска только как запасной вариант
+    sent_message = None
+    if memory['photo_file_id']:
+        try:
+            sent_message = await render_card(
+                chat_id, text, markup, photo=memory['photo_file_id'], message=message
+            )
+        except TelegramBadRequest as e:
+            logger.error("file_id воспоминания %s не принят: %s", memory['id'], e)
+
+    content = None
+    if sent_message is None and memory['photo_path']:
+        content = await load_memory_photo(memory['photo_path'])
+
+    if content is not None:
+        sent_message = await render_card(
+            chat_id,
+            text,
+            markup,
+            photo=types.BufferedInputFile(content, filename="memory.jpg"),
+            message=message
         )
+        await save_memory_photo_file_id(memory['id'], sent_message.photo[-1].file_id)
+        # В закэшированных страницах остался старый file_id
+        await memory_history_cache.invalidate(chat_id)
+
+    if sent_message is None:
+        sent_message = await render_card(chat_id, text, markup, message=message)
     return sent_message.message_id 
 
 
@@ -757,8 +2648,9 @@ async def memory_back_to_menu(callback: CallbackQuery, state: FSMContext):
     except:
         pass
     
-    # Очищаем состояние
+    # Очищаем состояние и сессию просмотра
     await state.clear()
+    await sessions.delete('memories', callback.from_user.id)
     
     # Показываем главное меню
     await show_main_menu(callback.message)
@@ -775,21 +2667,12 @@ async def handle_history_period(callback: CallbackQuery, state: FSMContext):
         await state.set_state(MemoryStates.waiting_for_start_date)
         return
 
-    if period == 'week':
-        memories = await get_memories(callback.from_user.id, 'week')
-        
-    elif period == 'month':
-        memories = await get_memories(callback.from_user.id, 'month')
-
-    if not memories:
+    start_date, end_date = history_period_range(period)
+    if not await open_memory_history(callback.from_user.id, start_date, end_date):
         await callback.message.delete()
         await callback.message.answer("За выбранный период воспоминаний не найдено")
         return
-    
-    memories_cache[callback.from_user.id] = memories
 
-    current_memory_index[callback.from_user.id] = 0
-    await show_memory_card(callback.from_user.id, memories, 0)
     await callback.message.delete()
 
 
@@ -806,7 +2689,8 @@ async def process_start_date(message: Message, state: FSMContext):
             return
         
         start_date = datetime.strptime(message.text, "%d.%m.%Y").date()
-        await state.update_data(start_date=start_date)
+        # Данные состояния сериализуются в JSON (Redis), поэтому храним дату строкой
+        await state.update_data(start_date=start_date.isoformat())
         await message.answer("Введите конечную дату периода (ДД.ММ.ГГГГ)")
         await state.set_state(MemoryStates.waiting_for_end_date)
     except ValueError:
@@ -822,7 +2706,7 @@ async def process_end_date(message: Message, state: FSMContext):
 
         end_date = datetime.strptime(message.text, "%d.%m.%Y").date()
         data = await state.get_data()
-        start_date = data.get('start_date')
+        start_date = date_class.fromisoformat(data['start_date'])
 
         if end_date > today:
             await message.answer("Конечная дата не может быть в будущем. Введите корректную дату.")
@@ -834,47 +2718,155 @@ async def process_end_date(message: Message, state: FSMContext):
             return
         
 
-        memories = await get_memories(
-            message.from_user.id,
-            start_date=start_date,
-            end_date=end_date
-        )
-
-        if not memories:
+        if not await open_memory_history(message.from_user.id, start_date, end_date):
             await message.answer("За выбранный период воспоминаний не найдено")
             return
 
-        memories_cache[message.from_user.id] = memories
-        current_memory_index[message.from_user.id] = 0
-        await show_memory_card(message.from_user.id, memories, 0)
         await state.clear()
 
     except ValueError:
         await message.answer("Неверный формат даты. Введите дату в формате ДД.ММ.ГГГГ")
 
 
+# Открытие истории: первая карточка и небольшое окно следующих, остальное читается по мере листания
+async def open_memory_history(user_id: int, start_date: date_class, end_date: date_class) -> bool:
+    memories = await get_memories(user_id, start_date, end_date, limit=MEMORY_PREFETCH + 1)
+    if not memories:
+        return False
+
+    memory, ahead = memories[0], memories[1:]
+    await sessions.set('memories', user_id, {
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'current': memory_cursor(memory),
+        'ahead': [memory_to_session(m) for m in ahead],
+        'exhausted': len(memories) <= MEMORY_PREFETCH
+    })
+    await show_memory_card(user_id, memory, has_prev=False, has_next=bool(ahead))
+    return True
+
+
 # Обработчик навигации по воспоминаниям (теперь без параметра pool)
 @dp.callback_query(F.data.startswith("memory_"))
 async def handle_memory_navigation(callback: CallbackQuery):
-    data = callback.data.split("_")
-    direction = data[1]
-    current_index = int(data[2])
+    _, direction, cursor_value = callback.data.split("_", 2)
+    cursor = parse_memory_cursor(cursor_value)
     user_id = callback.from_user.id
 
-    # Получаем воспоминания из "кэша"
-    memories = await get_memories_from_cache(user_id)
-    if not memories:
+    # Из сессии берем период и предзагруженные карточки
+    session = await sessions.get('memories', user_id)
+    if not session:
         await callback.answer("Воспоминания не найдены")
         return
+    # Кнопка со старой карточки или повторное нажатие: карточка уже показана
+    if session['current'] != cursor_value:
+        await callback.answer()
+        return
 
-    if direction == 'prev':
-        new_index = current_index - 1
+    start_date = date_class.fromisoformat(session['start_date'])
+    end_date = date_class.fromisoformat(session['end_date'])
+
+    if direction == 'next':
+        if session['ahead']:
+            memory = memory_from_session(session['ahead'].pop(0))
+            ahead = session['ahead']
+            exhausted = session['exhausted']
+        else:
+            memories = await get_memories(user_id, start_date, end_date, cursor, 'next', MEMORY_PREFETCH + 1)
+            if not memories:
+                await callback.answer("Воспоминания не найдены")
+                return
+            memory = memories[0]
+            ahead = [memory_to_session(m) for m in memories[1:]]
+            exhausted = len(memories) <= MEMORY_PREFETCH
+
+        # Окно закончилось: подгружаем следующее, чтобы знать, есть ли куда листать дальше
+        if not ahead and not exhausted:
+            memories = await get_memories(
+                user_id, start_date, end_date, (memory['date'], memory['id']), 'next', MEMORY_PREFETCH
+            )
+            ahead = [memory_to_session(m) for m in memories]
+            exhausted = len(memories) < MEMORY_PREFETCH
+
+        has_prev, has_next = True, bool(ahead)
     else:
-        new_index = current_index + 1
+        memories = await get_memories(user_id, start_date, end_date, cursor, 'prev', 2)
+        if not memories:
+            await callback.answer("Воспоминания не найдены")
+            return
+        memory = memories[0]
+        ahead, exhausted = [], False
+        has_prev, has_next = len(memories) > 1, True
 
-    current_memory_index[user_id] = new_index
-    await callback.message.delete()
-    await show_memory_card(user_id, memories, new_index)
+    session.update(current=memory_cursor(memory), ahead=ahead, exhausted=exhausted)
+    await sessions.set('memories', user_id, session)
+    await show_memory_card(user_id, memory, has_prev, has_next, message=callback.message)
+    await callback.answer()
+
+
+# Статистика воспоминаний: считается по сводкам, а не по всем записям
+async def get_memory_stats(user_id: int) -> dict:
+    today = datetime.now(city_timezone(await get_user_city(user_id))).date()
+    key = ('stats', today)
+    version = await memory_history_cache.version(user_id)
+    stats = memory_history_cache.get(user_id, key, version)
+    if stats is not None:
+        return stats
+
+    months = await db_fetch('memory_stats_months', user_id)
+    places = await db_fetch('memory_stats_top_places', user_id, 3)
+    streaks = (await db_fetch('memory_streaks', user_id, today - timedelta(days=STATS_STREAK_DAYS)))[0]
+
+    def average(rows):
+        rated = sum(row['rated'] for row in rows)
+        return sum(row['rating_sum'] for row in rows) / rated if rated else None
+
+    this_month = [row for row in months if row['month'] == today.replace(day=1)]
+    latest_day = streaks['latest_day']
+    stats = {
+        'total': sum(row['memories'] for row in months),
+        'avg_rating': average(months),
+        'month_total': sum(row['memories'] for row in this_month),
+        'month_avg_rating': average(this_month),
+        'best_month': max(months, key=lambda row: row['memories'], default=None),
+        'top_places': [(row['place'], row['avg_rating'], row['memories']) for row in places],
+        'longest_streak': streaks['longest'] or 0,
+        # Серия продолжается, если последнее воспоминание сегодня или вчера
+        'current_streak': streaks['latest_length'] if latest_day and latest_day >= today - timedelta(days=1) else 0,
+    }
+    memory_history_cache.put(user_id, key, stats, version)
+    return stats
+
+
+def format_memory_stats(stats: dict) -> str:
+    def rating_text(value):
+        return f"{value:.1f}" if value is not None else "—"
+
+    lines = [
+        "📊 <b>Ваша статистика</b>\n",
+        f"📝 Всего воспоминаний: {stats['total']}",
+        f"⭐ Средняя оценка: {rating_text(stats['avg_rating'])}",
+        f"📅 В этом месяце: {stats['month_total']}, средняя оценка {rating_text(stats['month_avg_rating'])}",
+    ]
+    if stats['best_month'] is not None:
+        best = stats['best_month']
+        lines.append(f"🏆 Самый насыщенный месяц: {best['month']:%m.%Y} ({best['memories']})")
+    lines.append(f"🔥 Дней подряд сейчас: {stats['current_streak']}, рекорд за год: {stats['longest_streak']}")
+    if stats['top_places']:
+        lines.append("\n📍 <b>Лучшие места:</b>")
+        for place, avg_rating, count in stats['top_places']:
+            lines.append(f"• {html.escape(place)} — {avg_rating:.1f} ({count})")
+    return "\n".join(lines)
+
+
+@dp.message(Command("stats"))
+@dp.message(F.text == "Статистика")
+async def cmd_stats(message: Message):
+    stats = await get_memory_stats(message.from_user.id)
+    if not stats['total']:
+        await message.answer("Пока нет ни одного воспоминания — добавьте первое через «На память»")
+        return
+    await message.answer(format_memory_stats(stats), parse_mode='HTML')
 
 
 # Обработчик возврата в меню
@@ -896,25 +2888,434 @@ async def back_to_main_menu(callback: CallbackQuery, state: FSMContext):
         pass
     
     await state.clear()
+    await sessions.delete('events', callback.from_user.id)
+    image_prefetcher.cancel(callback.from_user.id)
     await show_main_menu(callback.message, "Главное меню")
     await callback.answer()
 
 
-async def get_events_from_cache(user_id: int):
-    """Получение событий из кэша"""
-    return events_cache.get(user_id)
+# Метрики обработчиков: время и ошибки по имени функции-обработчика
+class HandlerMetricsMiddleware(BaseMiddleware):
+    def __init__(self, samples: int = 10000):
+        # Последние замеры по обработчикам — для перцентилей в сводке производительности
+        self.samples = {}
+        self.max_samples = samples
+        self.handled = 0
 
-async def get_memories_from_cache(user_id: int):
-    """Получение воспоминаний из кэша"""
-    return memories_cache.get(user_id)
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object else 'unknown'
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.labels(name).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.labels(name).observe(elapsed)
+            self.handled += 1
+            self.samples.setdefault(name, deque(maxlen=self.max_samples)).append(elapsed)
+
+
+handler_metrics = HandlerMetricsMiddleware()
+dp.message.middleware(handler_metrics)
+dp.callback_query.middleware(handler_metrics)
+
+
+# Навигация по карточкам: нажатия одного пользователя обрабатываются по очереди, из серии — только последнее
+NAVIGATION_PREFIXES = ('event_prev_', 'event_next_', 'memory_prev_', 'memory_next_')
+
+
+class NavigationDebounceMiddleware(BaseMiddleware):
+    """Последовательная обработка навигации пользователя с отбрасыванием всех нажатий, кроме последнего"""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+        self._users = {}  # user_id -> [номер последнего нажатия, Lock, число нажатий в обработке]
+        self._taps = itertools.count(1)
+        self.dropped = 0
+
+    async def __call__(self, handler, event: CallbackQuery, data):
+        if not event.data or not event.data.startswith(NAVIGATION_PREFIXES):
+            return await handler(event, data)
+
+        user_id = event.from_user.id
+        state = self._users.get(user_id)
+        if state is None:
+            state = self._users[user_id] = [0, asyncio.Lock(), 0]
+        tap = next(self._taps)
+        state[0] = tap
+        state[2] += 1
+        try:
+            if self.delay:
+                await asyncio.sleep(self.delay)
+            async with state[1]:
+                if state[0] != tap:
+                    # Пока это нажатие ждало, пришло более новое: только убираем "часики" с кнопки
+                    self.dropped += 1
+                    await event.answer()
+                    return None
+                return await handler(event, data)
+        finally:
+            state[2] -= 1
+            if state[2] == 0:
+                self._users.pop(user_id, None)
+
+
+navigation_debounce = NavigationDebounceMiddleware(NAVIGATION_DEBOUNCE)
+dp.callback_query.middleware(navigation_debounce)
+
+
+# Ограничение исходящих запросов к Bot API
+class CardUpdateSuperseded(Exception):
+    """Пользователь уже перешел к другой карточке, эта отрисовка больше не нужна"""
+
+
+# (chat_id, версия) карточки, которую отрисовывает текущий обработчик
+card_update = contextvars.ContextVar('card_update', default=None)
+
+
+class OutboundRateLimitMiddleware(BaseRequestMiddleware):
+    """Token bucket на чат и общий, ожидание retry_after после 429 и отбрасывание устаревших карточек"""
+
+    def __init__(self, chat_rate: float, chat_burst: int, global_rate: float, global_burst: int,
+                 max_retries: int, max_chats: int = 10000, service_chats: dict = None):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chat_buckets = OrderedDict()  # chat_id -> TokenBucket
+        # Служебные чаты бота со своим лимитом вместо общего для чатов пользователей
+        self._service_buckets = {
+            chat_id: TokenBucket(rate, burst) for chat_id, (rate, burst) in (service_chats or {}).items()
+        }
+        self._paused_until = {}  # chat_id -> момент, до которого Telegram просил не писать
+        self._card_versions = OrderedDict()  # chat_id -> последняя версия карточки
+        self._versions = itertools.count(1)
+        self.retried = 0
+        self.dropped = 0
+
+    def _remember(self, cache: OrderedDict, chat_id, value):
+        cache[chat_id] = value
+        cache.move_to_end(chat_id)
+        while len(cache) > self.max_chats:
+            cache.popitem(last=False)
+
+    def begin_card(self, chat_id) -> contextvars.Token:
+        version = next(self._versions)
+        self._remember(self._card_versions, chat_id, version)
+        return card_update.set((chat_id, version))
+
+    def _superseded(self, chat_id, method) -> bool:
+        current = card_update.get()
+        # Удаление старой карточки не отбрасываем, иначе в чате останутся две
+        if current is None or current[0] != chat_id or isinstance(method, DeleteMessage):
+            return False
+        return self._card_versions.get(chat_id, current[1]) > current[1]
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._service_buckets.get(chat_id)
+        if bucket is not None:
+            return bucket
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+        self._remember(self._chat_buckets, chat_id, bucket)
+        return bucket
+
+    async def _wait_turn(self, chat_id, method):
+        paused_until = self._paused_until.get(chat_id)
+        if paused_until is not None:
+            delay = paused_until - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._paused_until.pop(chat_id, None)
+        # Удаление не отправляет сообщений в чат: на него тратится только общий лимит
+        if not isinstance(method, DeleteMessage):
+            await self._chat_bucket(chat_id).acquire()
+        await self._global.acquire()
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, 'chat_id', None)
+        if chat_id is None:
+            # Ответы на callback и служебные методы в лимиты сообщений не входят
+            return await make_request(bot, method)
+        if chat_id in self._service_buckets and isinstance(method, DeleteMessage):
+            # Удаление загрузки из служебного чата не отправляет сообщений и не ждет очереди
+            return await make_request(bot, method)
+
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id, method)
+            if self._superseded(chat_id, method):
+                self.dropped += 1
+                raise CardUpdateSuperseded()
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                self.retried += 1
+                self._paused_until[chat_id] = time.monotonic() + e.retry_after
+                logger.warning(
+                    "Telegram ограничил частоту, повтор через %s с", e.retry_after,
+                    extra={'chat_id': chat_id, 'method': type(method).__name__}
+                )
+
+
+outbound_limiter = OutboundRateLimitMiddleware(
+    OUTBOUND_CHAT_RATE,
+    OUTBOUND_CHAT_BURST,
+    OUTBOUND_GLOBAL_RATE,
+    OUTBOUND_GLOBAL_BURST,
+    OUTBOUND_MAX_RETRIES,
+    service_chats={IMAGE_CACHE_CHAT_ID: (IMAGE_CACHE_CHAT_RATE, IMAGE_PREFETCH_CONCURRENCY)}
+    if IMAGE_CACHE_CHAT_ID else None
+)
+
+
+# Метрики запросов к Telegram Bot API
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    def __init__(self):
+        self.calls = CallCounter()  # метод -> число запросов, включая повторы
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        self.calls[name] += 1
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception:
+            TELEGRAM_ERRORS.labels(name).inc()
+            raise
+        finally:
+            TELEGRAM_LATENCY.labels(name).observe(time.perf_counter() - started)
+
+
+# Лимитер регистрируется первым: метрики считают каждую попытку, а не время ожидания в очереди
+telegram_metrics = TelegramMetricsMiddleware()
+bot.session.middleware(outbound_limiter)
+bot.session.middleware(telegram_metrics)
+
+
+# Отброшенная устаревшая карточка — штатная ситуация: только снимаем "часики" с кнопки
+@dp.errors(ExceptionTypeFilter(CardUpdateSuperseded))
+async def on_card_superseded(event: types.ErrorEvent):
+    if event.update.callback_query is not None:
+        try:
+            await event.update.callback_query.answer()
+        except TelegramBadRequest:
+            pass
+    return True
+
+
+# Счетчики, которые уже ведутся в объектах бота, отдаются как gauge
+Gauge('bot_events_cache_hits', 'Попадания в кэш событий (память)').set_function(lambda: events_query_cache.hits)
+Gauge('bot_events_cache_redis_hits', 'Попадания в кэш событий (Redis)').set_function(
+    lambda: events_query_cache.redis_hits
+)
+Gauge('bot_events_cache_misses', 'Промахи кэша событий').set_function(lambda: events_query_cache.misses)
+Gauge('bot_events_cache_upstream_calls', 'Запросы к KudaGo из кэша').set_function(
+    lambda: events_query_cache.upstream_calls
+)
+Gauge('bot_outbound_retried', 'Повторов запросов к Bot API после 429').set_function(
+    lambda: outbound_limiter.retried
+)
+Gauge('bot_outbound_dropped', 'Отброшенных устаревших карточек').set_function(lambda: outbound_limiter.dropped)
+Gauge('bot_navigation_dropped', 'Отброшенных быстрых нажатий навигации').set_function(
+    lambda: navigation_debounce.dropped
+)
+Gauge('bot_memory_writer_inserted', 'Записано воспоминаний').set_function(lambda: memory_writer.inserted)
+Gauge('bot_memory_writer_pending', 'Воспоминаний в очереди на запись').set_function(lambda: memory_writer.pending)
+Gauge('bot_db_pool_size', 'Открытых соединений пула').set_function(lambda: pool.get_size() if pool else 0)
+Gauge('bot_db_pool_idle', 'Свободных соединений пула').set_function(lambda: pool.get_idle_size() if pool else 0)
+Gauge('bot_db_pool_waiting', 'Ожидающих соединение').set_function(lambda: pool_stats.waiting)
+
+
+# Сводка производительности за время работы процесса
+started_at = time.monotonic()
+
+
+def peak_rss_mb():
+    # Модуль resource есть только в Unix
+    try:
+        import resource
+    except ImportError:
+        return None
+    # ru_maxrss в Linux в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def performance_summary() -> dict:
+    uptime = time.monotonic() - started_at
+    api_calls = sum(telegram_metrics.calls.values())
+    handled = handler_metrics.handled
+    handlers = {}
+    for name, samples in handler_metrics.samples.items():
+        latencies = sorted(samples)
+        handlers[name] = {
+            'count': len(latencies),
+            'p50_ms': percentile(latencies, 0.5) * 1000,
+            'p95_ms': percentile(latencies, 0.95) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000,
+        }
+    return {
+        'uptime_s': uptime,
+        'handled': handled,
+        'throughput_per_s': handled / uptime if uptime else 0.0,
+        'handlers': handlers,
+        'bot_api_calls': dict(telegram_metrics.calls),
+        'bot_api_calls_per_interaction': api_calls / handled if handled else 0.0,
+        'kudago_upstream_calls': events_query_cache.upstream_calls,
+        'memories_inserted': memory_writer.inserted,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def dump_performance_summary(path: str):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(performance_summary(), f, ensure_ascii=False, indent=2)
+    logger.info("Сводка производительности сохранена в %s", path)
+
+
+# Локальный HTTP-эндпоинт /metrics
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(), headers={'Content-Type': CONTENT_TYPE_LATEST})
+
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Занятый порт метрик не должен мешать боту работать
+        logger.error("Не удалось открыть порт метрик %s:%s: %s", METRICS_HOST, METRICS_PORT, e)
+        await runner.cleanup()
+        return None
+    logger.info("Метрики доступны на http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    return runner
+
+
+# Ограничение числа одновременно обрабатываемых апдейтов
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """Пропускает не больше limit апдейтов одновременно и позволяет дождаться уже начатых"""
+
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            async with self._semaphore:
+                return await handler(event, data)
+        finally:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.set()
+
+    async def wait_idle(self, timeout: float):
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            logger.error("При остановке не завершились %d обработчиков", self._in_flight)
+
+
+concurrency_limiter = ConcurrencyLimitMiddleware(HANDLER_CONCURRENCY)
+dp.update.outer_middleware(concurrency_limiter)
+
+
+# Корректная остановка: сначала дожидаемся начатых обработчиков, потом закрываем ресурсы
+@dp.shutdown()
+async def on_shutdown():
+    global pool
+
+    await concurrency_limiter.wait_idle(SHUTDOWN_TIMEOUT)
+    image_prefetcher.cancel_all()
+    if background_tasks:
+        await asyncio.wait(background_tasks, timeout=SHUTDOWN_TIMEOUT)
+    await memory_writer.close()
+    await cache_warmer.close()
+    if STATS_DUMP_PATH:
+        dump_performance_summary(STATS_DUMP_PATH)
+    await kudago.close()
+    await dp.storage.close()
+    if pool is not None:
+        await pool.close()
+
+
+# Приложение aiohttp, принимающее апдейты на WEBHOOK_PATH
+def webhook_app() -> web.Application:
+    app = web.Application()
+    # setup_application регистрируется первым, чтобы сессия бота закрывалась после остановки диспетчера
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dispatcher=dp,
+        bot=bot,
+        secret_token=WEBHOOK_SECRET
+    ).register(app, path=WEBHOOK_PATH)
+    return app
+
+
+# Запуск в режиме webhook
+async def run_webhook():
+    if not WEBHOOK_SECRET:
+        raise RuntimeError("Для режима webhook нужно задать WEBHOOK_SECRET")
+
+    runner = web.AppRunner(webhook_app())
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+
+    await bot.set_webhook(
+        f"{WEBHOOK_BASE_URL.rstrip('/')}{WEBHOOK_PATH}",
+        secret_token=WEBHOOK_SECRET
+    )
+    logger.info("Webhook запущен на %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    try:
+        await stop_event.wait()
+    finally:
+        # Перестаем принимать запросы, затем срабатывает on_shutdown диспетчера
+        await runner.cleanup()
 
 
 # Запуск бота с подключением к БД
 async def main():
     global pool
     pool = await init_db()  # Инициализация БД перед запуском
-    await dp.start_polling(bot)
+    memory_writer.start()
+    if WARMUP_ENABLED:
+        cache_warmer.start()
+    metrics_runner = await start_metrics_server()
+    try:
+        if BOT_MODE == 'webhook':
+            await run_webhook()
+        else:
+            # После запуска в режиме webhook Telegram не отдаст getUpdates, пока webhook не снят
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 if __name__ == '__main__':
-    import asyncio
-    asyncio.run(main())
+    log_listener = setup_logging()
+    try:
+        asyncio.run(main())
+    finally:
+        log_listener.stop()
@@ -0,0 +1,58 @@
+import contextlib
+import os
+import sys
+
+import pytest
+
+# bot.py читает настройки при импорте: тесты не ходят во внешние сервисы, даже если рядом лежит .env
+os.environ.setdefault('BOT_TOKEN', '123456:ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghi')
+os.environ['DATABASE_URL'] = ''
+os.environ['REDIS_URL'] = ''
+os.environ['FSM_STORAGE'] = 'memory'
+os.environ['BOT_MODE'] = 'polling'
+os.environ['WEBHOOK_BASE_URL'] = ''
+os.environ['WEBHOOK_SECRET'] = ''
+os.environ['TELEGRAM_API_URL'] = ''
+os.environ['METRICS_PORT'] = '0'
+os.environ['WARMUP_ENABLED'] = '0'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def unlimited_outbound(monkeypatch):
+    """Фейковый Bot API лимитов не держит: тесты не ждут токенов исходящих запросов"""
+    import bot
+    monkeypatch.setattr(bot.navigation_debounce, 'delay', 0)
+    monkeypatch.setattr(bot.outbound_limiter, 'chat_rate', 10000)
+    monkeypatch.setattr(bot.outbound_limiter, 'chat_burst', 10000)
+    monkeypatch.setattr(bot.outbound_limiter, '_global', bot.TokenBucket(10000, 10000))
+    monkeypatch.setattr(bot.outbound_limiter, '_chat_buckets', bot.OrderedDict())
+
+
+@pytest.fixture
+def fake_services(monkeypatch, unlimited_outbound):
+    """Поднимает фейковые Bot API и KudaGo и направляет на них бота; после теста все закрывается"""
+    from aiogram.client.telegram import TelegramAPIServer
+
+    import bot
+    from bench.fakes import FakeBotAPI, FakeKudaGo, FakeUsers
+
+    @contextlib.asynccontextmanager
+    async def start(api: FakeBotAPI = None, **kudago_options):
+        api = await (api or FakeBotAPI()).start()
+        kudago = await FakeKudaGo(**kudago_options).start()
+        monkeypatch.setattr(bot.bot.session, 'api', TelegramAPIServer.from_base(api.url))
+        monkeypatch.setattr(bot.kudago, 'base_url', kudago.url)
+        # Свой кэш запросов на тест: запросы действительно доходят до фейкового KudaGo
+        monkeypatch.setattr(bot, 'events_query_cache', bot.EventsQueryCache(60, 10))
+        try:
+            yield FakeUsers(bot, api), kudago
+        finally:
+            bot.image_prefetcher.cancel_all()
+            await bot.kudago.close()
+            await bot.bot.session.close()
+            await api.close()
+            await kudago.close()
+
+    return start
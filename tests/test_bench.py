@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+import bot
+from bench.dispatch import run_dispatch_benchmark
+from bench.run import run_benchmark
+
+
+@pytest.mark.parametrize('mode', ['feed', 'webhook', 'polling'])
+def test_events_flow_runs_in_every_mode(monkeypatch, unlimited_outbound, mode):
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', 'test-secret')
+    middlewares = len(bot.dp.update.outer_middleware)
+
+    result = asyncio.run(run_benchmark(bot, mode, ('events', 'history'), users=3, steps=3))
+
+    events = result['scenarios']['events']
+    # Поехали!, категория, дата и три нажатия "Дальше" на каждого пользователя
+    assert events['updates'] == 18
+    assert events['errors'] == 0
+    # Первая страница событий общая для всех пользователей (и могла остаться в кэше от прошлого прогона)
+    assert events['kudago_requests'] <= 1
+    assert 0 < events['bot_api_calls_per_update'] < 3
+    assert result['scenarios']['history'] == {'skipped': 'нужен DATABASE_URL'}
+    assert result['bot']['handled'] > 0
+    # Прогон не оставляет своих middleware в общем dp
+    assert len(bot.dp.update.outer_middleware) == middlewares
+
+
+def test_dispatch_benchmark_measures_metrics_middleware():
+    result = asyncio.run(run_dispatch_benchmark(bot, updates=200, rounds=2))
+
+    # Каждый апдейт измеряемых прогонов прошел через HandlerMetricsMiddleware
+    assert result['handled'] == 200 * 2
+    assert result['baseline_us'] > 0 and result['with_metrics_us'] > 0
+    assert result['overhead_us'] == result['with_metrics_us'] - result['baseline_us']
@@ -0,0 +1,55 @@
+import asyncio
+
+import bot
+from bench.run import Bench
+
+USER_ID = 5005
+
+
+def test_event_navigation_edits_the_card_in_place(fake_services):
+    async def scenario():
+        async with fake_services() as (users, kudago):
+            api = users.api
+            await users.send(users.message(USER_ID, "Поехали!"))
+            await users.send(users.callback(USER_ID, "category_exhibition"))
+            await users.send(users.callback(USER_ID, "date_today_exhibition"))
+            before = api.calls.copy()
+            direction, back = 'event_next_', 'event_prev_'
+            for _ in range(100):
+                data = api.callback_data(USER_ID, direction)
+                if data is None:
+                    # Дошли до края выдачи: листаем в обратную сторону
+                    direction, back = back, direction
+                    data = api.callback_data(USER_ID, direction)
+                await users.send(users.callback(USER_ID, data))
+            return api.calls - before
+
+    calls = asyncio.run(scenario())
+    # 100 нажатий "Дальше" и "Назад": одно редактирование карточки и ответ на callback, без удаления и повторной отправки
+    assert calls == {'editmessagemedia': 100, 'answercallbackquery': 100}
+
+
+def test_burst_of_taps_renders_only_the_last_card(monkeypatch, fake_services):
+    monkeypatch.setattr(bot.navigation_debounce, 'delay', bot.NAVIGATION_DEBOUNCE)
+
+    async def scenario():
+        async with fake_services() as (users, _):
+            api = users.api
+            async with Bench(bot, api, 'feed') as bench:
+                await bench.send(bench.message(USER_ID, "Поехали!"))
+                await bench.send(bench.callback(USER_ID, "category_exhibition"))
+                await bench.send(bench.callback(USER_ID, "date_today_exhibition"))
+                for _ in range(2):
+                    await bench.send(bench.callback(USER_ID, api.callback_data(USER_ID, 'event_next_')))
+                before = api.calls.copy()
+                # Пользователь быстро жмет "Дальше" и "Назад" на карточке 3; последним нажато "Назад"
+                taps = ['event_next_2', 'event_prev_2'] * 4
+                await asyncio.gather(*(bench.send(bench.callback(USER_ID, data)) for data in taps))
+                return api.calls - before, bench.errors, api.sent[-1]
+
+    calls, errors, (_, method, caption) = asyncio.run(scenario())
+    assert errors == 0
+    assert calls == {'editmessagemedia': 1, 'answercallbackquery': 8}
+    # Показана карточка 2, на которую вело последнее нажатие, а не карточка 4 после первого
+    assert method == 'editmessagemedia'
+    assert "<b>Событие 2</b>" in caption
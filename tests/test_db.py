@@ -0,0 +1,241 @@
+import asyncio
+import json
+import os
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import bot
+
+# Тесты планов запросов идут только на локальном Postgres: TEST_DATABASE_URL=postgresql://localhost/bot_test
+TEST_DATABASE_URL = os.getenv('TEST_DATABASE_URL')
+pytestmark = pytest.mark.skipif(not TEST_DATABASE_URL, reason="нужен TEST_DATABASE_URL")
+
+USER_BASE = 700_000_000
+INDEX_NAME = 'memories_user_date_id_idx'
+
+
+async def open_pool(monkeypatch):
+    monkeypatch.setattr(bot, 'DATABASE_URL', TEST_DATABASE_URL)
+    monkeypatch.setattr(bot, 'pool', None)
+    return await bot.init_db()
+
+
+async def reset_users(pool, user_ids: list):
+    for table in ('memories', 'memory_stats_monthly', 'memory_stats_places', 'user_cities'):
+        await pool.execute(f"DELETE FROM {table} WHERE user_id = ANY($1::bigint[])", user_ids)
+
+
+async def seed(pool, user_id: int, count: int):
+    today = date.today()
+    records = [
+        (user_id, today - timedelta(days=i % 30), f"Место {i % 50}", i % 10 + 1, f"Описание {i}")
+        for i in range(count)
+    ]
+    await pool.copy_records_to_table(
+        'memories', records=records, columns=['user_id', 'date', 'place', 'rating', 'description']
+    )
+
+
+async def explain(pool, name: str, *args) -> list:
+    """Узлы плана подготовленного запроса с фактическим числом строк"""
+    raw = await pool.fetchval(f"EXPLAIN (ANALYZE, FORMAT JSON) {bot.PREPARED_QUERIES[name]}", *args)
+    nodes, stack = [], [json.loads(raw)[0]['Plan']]
+    while stack:
+        node = stack.pop()
+        nodes.append(node)
+        stack.extend(node.get('Plans', []))
+    return nodes
+
+
+def index_scan(nodes: list) -> dict:
+    assert not any(node['Node Type'] == 'Seq Scan' for node in nodes)
+    scans = [node for node in nodes if node.get('Index Name') == INDEX_NAME]
+    assert scans, [node['Node Type'] for node in nodes]
+    return scans[0]
+
+
+def test_history_queries_use_composite_index(monkeypatch):
+    user_ids = [USER_BASE + i for i in range(200)]
+
+    async def scenario():
+        pool = await open_pool(monkeypatch)
+        try:
+            await reset_users(pool, user_ids)
+            for user_id in user_ids:
+                await seed(pool, user_id, 100)
+            await pool.execute("ANALYZE memories")
+
+            end = date.today()
+            start = end - timedelta(days=30)
+            first = await explain(pool, 'memories_first', user_ids[0], start, end, 6)
+            older = await explain(pool, 'memories_older', user_ids[0], start, end, end - timedelta(days=10), 0, 6)
+            return first, older
+        finally:
+            await reset_users(pool, user_ids)
+            await pool.close()
+
+    for nodes in asyncio.run(scenario()):
+        index_scan(nodes)
+
+
+def test_page_cost_does_not_grow_with_depth(monkeypatch):
+    user_id = USER_BASE + 1000
+    limit = bot.MEMORY_PREFETCH + 1
+
+    async def scenario():
+        pool = await open_pool(monkeypatch)
+        try:
+            await reset_users(pool, [user_id])
+            await seed(pool, user_id, 100_000)
+            await pool.execute("ANALYZE memories")
+
+            end = date.today()
+            start = end - timedelta(days=30)
+            deep = await pool.fetchrow(
+                """SELECT date, id FROM memories WHERE user_id = $1
+                ORDER BY date DESC, id DESC OFFSET 90000 LIMIT 1""",
+                user_id
+            )
+            shallow = await explain(pool, 'memories_first', user_id, start, end, limit)
+            deep = await explain(pool, 'memories_older', user_id, start, end, deep['date'], deep['id'], limit)
+            return shallow, deep
+        finally:
+            await reset_users(pool, [user_id])
+            await pool.close()
+
+    for nodes in asyncio.run(scenario()):
+        scan = index_scan(nodes)
+        # Курсор входит в условие индекса: страница читает limit строк на любой глубине истории
+        assert scan['Actual Rows'] <= limit
+        assert scan.get('Rows Removed by Filter', 0) == 0
+
+
+def test_history_browsing_keeps_a_bounded_window(monkeypatch, fake_services):
+    user_id = USER_BASE + 2000
+
+    async def scenario():
+        pool = await open_pool(monkeypatch)
+        try:
+            await reset_users(pool, [user_id])
+            await seed(pool, user_id, 100_000)
+            async with fake_services() as (users, _):
+                await users.send(users.message(user_id, "История"))
+                await users.send(users.callback(user_id, "history_month"))
+                for _ in range(30):
+                    await users.send(users.callback(user_id, users.api.callback_data(user_id, 'memory_next_')))
+                return await bot.sessions.get('memories', user_id)
+        finally:
+            await reset_users(pool, [user_id])
+            await pool.close()
+
+    session = asyncio.run(scenario())
+    # В сессии только текущая карточка и небольшое окно следующих, а не весь период
+    assert len(session['ahead']) <= bot.MEMORY_PREFETCH
+
+
+async def stats_rows(pool, user_id: int) -> tuple:
+    monthly = await pool.fetch(
+        "SELECT user_id, month, memories, rated, rating_sum FROM memory_stats_monthly WHERE user_id = $1", user_id
+    )
+    places = await pool.fetch(
+        "SELECT user_id, place, memories, rated, rating_sum FROM memory_stats_places WHERE user_id = $1", user_id
+    )
+    return sorted(tuple(row) for row in monthly), sorted(tuple(row) for row in places)
+
+
+def stats_records(user_id: int) -> list:
+    places = [" Парк\t", "Парк", "\nПарк ", "Кафе", "   ", None]
+    return [
+        (user_id, date(2024, 1 + i % 3, 1 + i % 28), places[i % len(places)], None if i % 4 == 0 else i % 10 + 1,
+         f"Описание {i}")
+        for i in range(60)
+    ]
+
+
+def expected_stats(records: list) -> tuple:
+    monthly, places = bot.memory_stats_deltas(records)
+    return sorted(monthly), sorted(places)
+
+
+def test_backfill_matches_incremental_stats(monkeypatch):
+    user_id = USER_BASE + 3000
+    records = stats_records(user_id)
+
+    async def scenario():
+        pool = await open_pool(monkeypatch)
+        try:
+            await reset_users(pool, [user_id])
+            # Записи без сводок, как от процесса старой версии: сводки расходятся с memories
+            await pool.copy_records_to_table(
+                'memories', records=records, columns=['user_id', 'date', 'place', 'rating', 'description']
+            )
+            async with pool.acquire() as conn:
+                rebuilt = await bot.backfill_memory_stats(conn)
+                again = await bot.backfill_memory_stats(conn)
+            return rebuilt, again, await stats_rows(pool, user_id)
+        finally:
+            await reset_users(pool, [user_id])
+            await pool.close()
+
+    rebuilt, again, rows = asyncio.run(scenario())
+    assert (rebuilt, again) == (True, False)
+    # SQL и memory_stats_deltas одинаково нормализуют места
+    assert rows == expected_stats(records)
+
+
+def test_memory_writer_upserts_stats(monkeypatch):
+    user_id = USER_BASE + 4000
+    records = stats_records(user_id)
+
+    async def scenario():
+        pool = await open_pool(monkeypatch)
+        writer = bot.MemoryWriter(batch_size=10, flush_interval=0.01, max_queue=100)
+        try:
+            await reset_users(pool, [user_id])
+            writer.start()
+            # Несколько пачек: сводки одного месяца и места прибавляются к уже записанным
+            for chunk in range(0, len(records), 15):
+                futures = [await writer.submit(record + (None,)) for record in records[chunk:chunk + 15]]
+                await asyncio.gather(*futures)
+            await writer.close()
+            count = await pool.fetchval("SELECT COUNT(*) FROM memories WHERE user_id = $1", user_id)
+            return count, await stats_rows(pool, user_id)
+        finally:
+            await reset_users(pool, [user_id])
+            await pool.close()
+
+    count, rows = asyncio.run(scenario())
+    assert count == len(records)
+    assert rows == expected_stats(records)
+
+
+def test_top_places_and_streaks(monkeypatch):
+    user_id = USER_BASE + 5000
+    today = datetime.now(bot.city_timezone(bot.DEFAULT_CITY)).date()
+    days_ago = (
+        [(0, "Парк", 9), (1, "Парк", 9), (2, "Кафе", 10)]  # текущая серия: 3 дня
+        + [(d, "Музей", 5) for d in range(10, 15)]  # рекорд за год: 5 дней
+        + [(d, "Сквер", None) for d in range(400, 420)]  # серия длиннее, но старше года
+    )
+    records = [(user_id, today - timedelta(days=d), place, rating, "") for d, place, rating in days_ago]
+
+    async def scenario():
+        pool = await open_pool(monkeypatch)
+        try:
+            await reset_users(pool, [user_id])
+            await pool.copy_records_to_table(
+                'memories', records=records, columns=['user_id', 'date', 'place', 'rating', 'description']
+            )
+            async with pool.acquire() as conn:
+                await bot.backfill_memory_stats(conn)
+            return await bot.get_memory_stats(user_id)
+        finally:
+            await reset_users(pool, [user_id])
+            await pool.close()
+
+    stats = asyncio.run(scenario())
+    assert stats['total'] == len(records)
+    # Места без оценок в топ не попадают
+    assert stats['top_places'] == [("Кафе", 10.0, 1), ("Парк", 9.0, 2), ("Музей", 5.0, 5)]
+    assert (stats['current_streak'], stats['longest_streak']) == (3, 5)
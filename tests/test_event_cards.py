@@ -0,0 +1,66 @@
+import asyncio
+import sys
+
+import bot
+
+
+def deep_sizeof(value, seen=None) -> int:
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set)):
+        size += sum(deep_sizeof(item, seen) for item in value)
+    elif hasattr(value, '__slots__'):
+        size += sum(deep_sizeof(getattr(value, name), seen) for name in ('caption', 'image_url'))
+    return size
+
+
+def kudago_event(event_id: int) -> dict:
+    # Событие в том виде, в каком его отдает KudaGo с expand=place
+    return {
+        'id': event_id,
+        'title': f"Выставка {event_id}",
+        'description': "Описание события. " * 60,
+        'place': {'id': 1, 'name': "Манеж", 'address': "Исаакиевская пл., 1", 'coords': {'lat': 59.9, 'lon': 30.3},
+                  'subway': "Адмиралтейская", 'site_url': "https://kudago.com/spb/place/manege/"},
+        'price': "от 500 до 1000 рублей",
+        'images': [{'image': f"https://kudago.com/media/images/event/{event_id}/{i}.jpg",
+                    'source': {'name': "kudago", 'link': "https://kudago.com"}} for i in range(5)],
+        'site_url': f"https://kudago.com/spb/event/{event_id}/",
+    }
+
+
+def test_card_is_compact_and_shared_between_users():
+    raw = kudago_event(1)
+    first = bot.normalize_event(raw)
+    second = bot.normalize_event(kudago_event(1))
+
+    assert second is first
+    assert not hasattr(first, '__dict__')
+    assert first.caption.startswith("🎟 <b>Выставка 1</b>")
+    # Байт на событие в кэше против исходного JSON
+    assert deep_sizeof(first) * 5 < deep_sizeof(raw)
+
+
+def test_event_sessions_do_not_hold_events(fake_services):
+    users = [17_000 + i for i in range(100)]
+
+    async def scenario():
+        async with fake_services() as (chats, kudago):
+            await asyncio.gather(*(chats.send(chats.callback(user_id, "date_today_concert")) for user_id in users))
+            sessions = [await bot.sessions.get('events', user_id) for user_id in users]
+            return sessions, kudago.page_size, kudago.requests
+
+    sessions, page_size, requests = asyncio.run(scenario())
+    # Одновременные одинаковые запросы схлопываются в один поход в KudaGo
+    assert requests == 1
+    assert all(session['index'] == 0 for session in sessions)
+    # Сессия хранит только параметры запроса: байт на сессию не зависит от числа событий
+    assert max(deep_sizeof(session) for session in sessions) < 1024
+    # Все пользователи смотрят одни и те же объекты карточек из общего кэша
+    cards = {id(card) for entry in bot.events_query_cache._local.values() for card in entry[2][0]}
+    assert len(cards) == page_size
@@ -0,0 +1,16 @@
+import asyncio
+
+
+def test_second_display_of_an_image_sends_its_file_id(fake_services):
+    async def scenario():
+        async with fake_services() as (users, _):
+            for user_id in (3001, 3002):
+                await users.send(users.callback(user_id, "date_today_concert"))
+            return users.api.photos, users.api.messages[3001]
+
+    photos, first_card = asyncio.run(scenario())
+    (first_chat, first_photo), (second_chat, second_photo) = photos
+    # Первый показ отдает Telegram ссылку, бот не скачивает и не загружает картинку
+    assert (first_chat, first_photo.startswith('http')) == (3001, True)
+    # Второй показ той же картинки идет по file_id из ответа на первый
+    assert (second_chat, second_photo) == (3002, first_card['photo'][-1]['file_id'])
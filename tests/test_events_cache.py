@@ -0,0 +1,109 @@
+import asyncio
+import json
+import time
+
+import fakeredis
+
+import bot
+
+
+def test_label_hit_rate_ignores_warmup_and_revalidation():
+    async def scenario():
+        cache = bot.EventsQueryCache(ttl=60, max_size=10, stale_ttl=60)
+
+        async def fetch():
+            return 'page'
+
+        # Прогрев и фоновые обновления ходят в API без обращений пользователей
+        for _ in range(5):
+            await cache.refresh('key', fetch, label='spb', reason='warmup')
+        await cache.refresh('key', fetch, label='spb', reason='revalidate')
+        await cache.get_or_fetch('key', fetch, label='spb')
+        await cache.get_or_fetch('other', fetch, label='spb')
+        return cache.stats()
+
+    stats = asyncio.run(scenario())
+    spb = stats['by_label']['spb']
+    assert spb == {'lookups': 2, 'misses': 1, 'revalidations': 1, 'warmups': 5, 'hit_rate': 0.5}
+    assert stats['warmups'] == 5
+    assert stats['upstream_calls'] == 7
+
+
+async def settle(cache: bot.EventsQueryCache):
+    """Ждет фоновые обновления устаревших записей"""
+    await asyncio.gather(*list(cache._revalidating.values()))
+
+
+def test_stale_entry_is_served_and_refreshed_once():
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return 'new'
+
+    async def scenario():
+        cache = bot.EventsQueryCache(ttl=60, max_size=10, stale_ttl=60)
+        cache._set_local('key', 'old', age=90)
+        # Пользователи не ждут KudaGo, а одновременные устаревшие попадания дают одно обновление
+        served = await asyncio.gather(*(cache.get_or_fetch('key', fetch) for _ in range(5)))
+        await settle(cache)
+        return served, await cache.get_or_fetch('key', fetch), cache.stats()
+
+    served, after, stats = asyncio.run(scenario())
+    assert served == ['old'] * 5
+    assert after == 'new'
+    assert len(calls) == 1
+    assert stats['stale_hits'] == 5 and stats['refreshes'] == 1
+
+
+def test_stale_redis_entry_is_refreshed():
+    server = fakeredis.FakeServer()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        return 'new'
+
+    async def scenario():
+        redis = fakeredis.FakeAsyncRedis(server=server)
+        # Запись оставил другой процесс полторы минуты назад: она устарела, но еще отдается
+        await redis.set('key', json.dumps({'fetched_at': time.time() - 90, 'value': 'old'}))
+        cache = bot.EventsQueryCache(ttl=60, max_size=10, redis_client=redis, stale_ttl=60)
+        served = await cache.get_or_fetch('key', fetch)
+        await settle(cache)
+        stored = json.loads(await redis.get('key'))
+        return served, await cache.get_or_fetch('key', fetch), stored['value']
+
+    served, after, stored = asyncio.run(scenario())
+    assert served == 'old'
+    assert (after, stored) == ('new', 'new')
+    assert len(calls) == 1
+
+
+def test_warmer_keeps_to_rate_budget(monkeypatch):
+    rate, burst = 50, 2
+    calls = []
+
+    async def refresh(key, fetch, label=None, reason='warmup'):
+        calls.append(time.monotonic())
+        return (bot.EventCard(len(calls), 'Событие', f"https://example.com/{len(calls)}.jpg"),), None
+
+    async def warm_image(url):
+        calls.append(time.monotonic())
+
+    monkeypatch.setattr(bot.events_query_cache, 'refresh', refresh)
+    monkeypatch.setattr(bot.image_prefetcher, 'warm', warm_image)
+
+    async def scenario():
+        warmer = bot.CacheWarmer(
+            60, [bot.DEFAULT_CITY], ['concert', 'exhibition', 'fun'], bot.TokenBucket(rate, burst), image_count=1
+        )
+        started = time.monotonic()
+        await warmer.warm()
+        return started
+
+    started = asyncio.run(scenario())
+    # Запросы событий и картинок: 3 категории x 2 дня x 2
+    assert len(calls) == 12
+    for sent, at in enumerate(calls, 1):
+        assert sent <= burst + rate * (at - started) + 0.5
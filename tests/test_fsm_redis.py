@@ -0,0 +1,85 @@
+import asyncio
+import importlib.util
+
+import fakeredis
+import pytest
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.redis import RedisStorage
+from prometheus_client import REGISTRY
+
+import bot
+from bench.fakes import FakeBotAPI, FakeUsers
+
+USER_ID = 4242
+
+
+@pytest.fixture
+def second_worker():
+    """Второй процесс бота: тот же bot.py, загруженный отдельным модулем со своим dp"""
+    original = list(REGISTRY._collector_to_names)
+    for collector in original:
+        REGISTRY.unregister(collector)
+    try:
+        spec = importlib.util.spec_from_file_location('bot_second_worker', bot.__file__)
+        worker = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(worker)
+    finally:
+        for collector in list(REGISTRY._collector_to_names):
+            REGISTRY.unregister(collector)
+        for collector in original:
+            REGISTRY.register(collector)
+    return worker
+
+
+def test_memory_dialog_continues_on_another_worker(monkeypatch, second_worker):
+    workers = [bot, second_worker]
+    saved = []
+
+    async def submit(record):
+        saved.append(record)
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(None)
+        return future
+
+    async def scenario():
+        server = fakeredis.FakeServer()
+        api = await FakeBotAPI().start()
+        chats = []
+        for worker in workers:
+            monkeypatch.setattr(worker.dp.fsm, 'storage', RedisStorage(
+                fakeredis.FakeAsyncRedis(server=server),
+                state_ttl=worker.FSM_STATE_TTL,
+                data_ttl=worker.FSM_STATE_TTL
+            ))
+            monkeypatch.setattr(worker.bot.session, 'api', TelegramAPIServer.from_base(api.url))
+            monkeypatch.setattr(worker.memory_writer, 'submit', submit)
+            chats.append(FakeUsers(worker, api))
+        first, second = chats
+        redis = fakeredis.FakeAsyncRedis(server=server)
+
+        try:
+            # Каждый следующий шаг диалога попадает на другой процесс
+            await first.send(first.message(USER_ID, "На память"))
+            await second.send(second.callback(USER_ID, "memory_date_today"))
+            await first.send(first.message(USER_ID, "Парк Горького"))
+            await second.send(second.callback(USER_ID, "rating_8"))
+            await first.send(first.message(USER_ID, "Гуляли до ночи"))
+
+            state_keys = await redis.keys('fsm:*')
+            assert state_keys
+            for key in state_keys:
+                assert 0 < await redis.ttl(key) <= bot.FSM_STATE_TTL
+
+            await second.send(second.callback(USER_ID, "skip_photo"))
+            return await redis.keys('fsm:*:state')
+        finally:
+            for worker in workers:
+                await worker.bot.session.close()
+            await api.close()
+
+    states_left = asyncio.run(scenario())
+    assert len(saved) == 1
+    user_id, _, place, rating, description, photo = saved[0]
+    assert (user_id, place, rating, description, photo) == (USER_ID, "Парк Горького", 8, "Гуляли до ночи", None)
+    # Диалог завершен: состояние очищено для всех процессов
+    assert states_left == []
@@ -0,0 +1,106 @@
+import asyncio
+
+import bot
+
+
+def run_prefetcher(monkeypatch, scenario, delay=0.05, download=True):
+    fetched = []
+
+    async def get_bytes(url, max_size=None):
+        await asyncio.sleep(delay)
+        fetched.append(url)
+        return b'image'
+
+    async def get_image_file_id(url):
+        return None
+
+    monkeypatch.setattr(bot.kudago, 'get_bytes', get_bytes)
+    monkeypatch.setattr(bot, 'get_image_file_id', get_image_file_id)
+
+    async def main():
+        prefetcher = bot.ImagePrefetcher(concurrency=4, byte_budget=10 ** 6, download=download)
+        await scenario(prefetcher)
+        return prefetcher
+
+    return asyncio.run(main()), fetched
+
+
+def test_overlapping_window_is_not_cancelled(monkeypatch):
+    async def scenario(prefetcher):
+        prefetcher.schedule(1, ['u1', 'u2', 'u3'])
+        await asyncio.sleep(0.02)
+        # Шаг "Дальше": u2 и u3 остаются в окне и должны докачаться
+        prefetcher.schedule(1, ['u2', 'u3', 'u4'])
+        await asyncio.sleep(0.2)
+
+    _, fetched = run_prefetcher(monkeypatch, scenario)
+    assert sorted(fetched) == ['u2', 'u3', 'u4']
+
+
+def test_url_is_kept_while_another_user_needs_it(monkeypatch):
+    async def scenario(prefetcher):
+        prefetcher.schedule(1, ['shared'])
+        prefetcher.schedule(2, ['shared'])
+        prefetcher.cancel(1)
+        await asyncio.sleep(0.2)
+
+    _, fetched = run_prefetcher(monkeypatch, scenario)
+    assert fetched == ['shared']
+
+
+def test_finished_users_leave_no_state(monkeypatch):
+    async def scenario(prefetcher):
+        for user_id in range(2000):
+            prefetcher.schedule(user_id, [f'image-{user_id}'])
+        await asyncio.sleep(0.1)
+
+    prefetcher, fetched = run_prefetcher(monkeypatch, scenario, delay=0)
+    assert len(fetched) == 2000
+    assert not prefetcher._user_urls
+    assert not prefetcher._wanted_by
+    assert not prefetcher._tasks
+
+
+def test_default_prefetch_does_not_download(monkeypatch):
+    async def scenario(prefetcher):
+        prefetcher.schedule(1, ['u1', 'u2'])
+        await asyncio.sleep(0.1)
+
+    # Без служебного чата и IMAGE_PREFETCH_BYTES картинку по ссылке скачает сам Telegram
+    _, fetched = run_prefetcher(monkeypatch, scenario, download=False)
+    assert fetched == []
+    assert not bot.image_prefetcher.download
+
+
+def test_downloads_in_flight_count_against_budget(monkeypatch):
+    budget = 400
+    prefetcher = bot.ImagePrefetcher(concurrency=8, byte_budget=budget, download=True)
+    fetched = []
+    peak = []
+
+    async def get_bytes(url, max_size=None):
+        assert max_size == budget // 4
+        peak.append(prefetcher._content_size + prefetcher._reserved)
+        await asyncio.sleep(0.05)
+        fetched.append(url)
+        return bytes(max_size)
+
+    async def get_image_file_id(url):
+        return None
+
+    monkeypatch.setattr(bot.kudago, 'get_bytes', get_bytes)
+    monkeypatch.setattr(bot, 'get_image_file_id', get_image_file_id)
+
+    async def scenario():
+        prefetcher.schedule(1, [f'u{i}' for i in range(8)])
+        await asyncio.sleep(0.2)
+        # Следующее окно вытесняет скачанное раньше, а не превышает бюджет
+        prefetcher.schedule(1, [f'v{i}' for i in range(2)])
+        await asyncio.sleep(0.2)
+
+    asyncio.run(scenario())
+    # Больше четырех картинок по budget // 4 одновременно не скачивается
+    assert len(fetched) == 4 + 2
+    assert max(peak) <= budget
+    assert prefetcher._content_size <= budget
+    assert prefetcher._reserved == 0
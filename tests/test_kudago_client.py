@@ -0,0 +1,23 @@
+import asyncio
+import time
+
+
+def test_slow_kudago_does_not_block_other_users(fake_services):
+    async def scenario():
+        async with fake_services(delay=1.5) as (users, kudago):
+            slow = asyncio.create_task(users.send(users.callback(1, "date_today_fun")))
+            await asyncio.sleep(0.1)
+
+            started = time.perf_counter()
+            for _ in range(5):
+                await users.send(users.message(2, "Поехали!"))
+            others = time.perf_counter() - started
+            still_waiting = not slow.done()
+            await slow
+            return others, still_waiting, kudago.requests
+
+    others, still_waiting, requests = asyncio.run(scenario())
+    # Пока один пользователь ждет KudaGo, остальные апдейты обрабатываются без задержки
+    assert still_waiting
+    assert others < 0.5
+    assert requests == 1
@@ -0,0 +1,44 @@
+import asyncio
+
+import fakeredis
+
+import bot
+
+
+def test_invalidation_reaches_other_processes_through_redis():
+    async def scenario():
+        server = fakeredis.FakeServer()
+        # Два процесса бота с общим Redis
+        first = bot.MemoryHistoryCache(10, 10, 300, fakeredis.FakeAsyncRedis(server=server))
+        second = bot.MemoryHistoryCache(10, 10, 300, fakeredis.FakeAsyncRedis(server=server))
+
+        version = await second.version(1)
+        second.put(1, 'page', ('old',), version)
+        assert second.get(1, 'page', await second.version(1)) == ('old',)
+
+        await first.invalidate(1)
+        return second.get(1, 'page', await second.version(1))
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_value_read_before_invalidation_is_not_cached():
+    async def scenario():
+        cache = bot.MemoryHistoryCache(10, 10, 300)
+        version = await cache.version(1)
+        await cache.invalidate(1)
+        cache.put(1, 'page', ('old',), version)
+        return cache.get(1, 'page', await cache.version(1))
+
+    assert asyncio.run(scenario()) is None
+
+
+def test_entries_expire_after_ttl():
+    async def scenario():
+        cache = bot.MemoryHistoryCache(10, 10, 0)
+        version = await cache.version(1)
+        cache.put(1, 'page', ('old',), version)
+        await asyncio.sleep(0.01)
+        return cache.get(1, 'page', await cache.version(1))
+
+    assert asyncio.run(scenario()) is None
@@ -0,0 +1,63 @@
+from datetime import date
+
+import bot
+
+
+def test_deltas_group_by_month_and_normalised_place():
+    records = [
+        (1, date(2024, 5, 3), " Парк\t", 8, "Описание", None),
+        (1, date(2024, 5, 20), "Парк", None, "Описание", None),
+        (1, date(2024, 6, 1), "\nПарк ", 6, "Описание", None),
+        (1, date(2024, 6, 2), "   ", 10, "Описание", None),
+        (2, date(2024, 5, 4), None, 3, "Описание", None),
+    ]
+
+    monthly, places = bot.memory_stats_deltas(records)
+
+    # (пользователь, месяц, записей, с оценкой, сумма оценок)
+    assert sorted(monthly) == [
+        (1, date(2024, 5, 1), 2, 1, 8),
+        (1, date(2024, 6, 1), 2, 2, 16),
+        (2, date(2024, 5, 1), 1, 1, 3),
+    ]
+    # Пустые места в сводку не попадают, пробелы по краям не делят одно место на несколько
+    assert places == [(1, "Парк", 3, 2, 14)]
+
+
+def test_deltas_truncate_long_place():
+    place = "М" * (bot.STATS_PLACE_MAX_LENGTH + 50)
+    _, places = bot.memory_stats_deltas([(1, date(2024, 5, 3), place, 5, "", None)])
+    assert places[0][1] == place[:bot.STATS_PLACE_MAX_LENGTH]
+
+
+def stats(**overrides) -> dict:
+    return dict({
+        'total': 12,
+        'avg_rating': 7.3,
+        'month_total': 3,
+        'month_avg_rating': None,
+        'best_month': {'month': date(2024, 5, 1), 'memories': 6},
+        'top_places': [("Кафе <Луна>", 9.5, 2)],
+        'longest_streak': 4,
+        'current_streak': 2,
+    }, **overrides)
+
+
+def test_format_memory_stats():
+    text = bot.format_memory_stats(stats())
+
+    assert "Всего воспоминаний: 12" in text
+    assert "Средняя оценка: 7.3" in text
+    # Месяц без оценок показывается прочерком, а не нулем
+    assert "В этом месяце: 3, средняя оценка —" in text
+    assert "Самый насыщенный месяц: 05.2024 (6)" in text
+    assert "Дней подряд сейчас: 2, рекорд за год: 4" in text
+    # Название места экранируется для parse_mode='HTML'
+    assert "• Кафе &lt;Луна&gt; — 9.5 (2)" in text
+
+
+def test_format_memory_stats_without_months_or_places():
+    text = bot.format_memory_stats(stats(best_month=None, top_places=[]))
+
+    assert "Самый насыщенный месяц" not in text
+    assert "Лучшие места" not in text
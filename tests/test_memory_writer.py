@@ -0,0 +1,104 @@
+import asyncio
+import gc
+from datetime import date
+
+import asyncpg
+
+import bot
+
+
+def record(place: str) -> tuple:
+    return (1, date(2024, 5, 1), place, 5, "Описание", None)
+
+
+def fake_db(monkeypatch, fail):
+    """db_executemany_atomic, который падает, пока fail(записи) возвращает ошибку"""
+    written = []
+
+    async def executemany_atomic(steps):
+        records = dict(steps)['insert_memory']
+        error = fail(records)
+        if error is not None:
+            raise error
+        written.extend(record[2] for record in records)
+
+    monkeypatch.setattr(bot, 'db_executemany_atomic', executemany_atomic)
+    return written
+
+
+async def write(writer: bot.MemoryWriter, places: list) -> list:
+    writer.start()
+    futures = [await writer.submit(record(place)) for place in places]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    await writer.close()
+    return results
+
+
+def test_connection_errors_are_retried_until_written(monkeypatch):
+    failures = iter([ConnectionResetError(), OSError()])
+    written = fake_db(monkeypatch, lambda records: next(failures, None))
+    writer = bot.MemoryWriter(batch_size=10, flush_interval=0.01, max_queue=100, retries=1, max_backoff=0.01)
+
+    results = asyncio.run(write(writer, ["А", "Б", "В"]))
+
+    # Пачка целиком не прошла, и записи дописались по одной после повторов
+    assert results == [None, None, None]
+    assert written == ["А", "Б", "В"]
+    assert writer.failed == 0
+
+
+def test_bad_row_loses_only_itself(monkeypatch):
+    def fail(records):
+        if any(record[2] == "плохое" for record in records):
+            return asyncpg.DataError("bad row")
+
+    written = fake_db(monkeypatch, fail)
+    writer = bot.MemoryWriter(batch_size=10, flush_interval=0.01, max_queue=100, max_backoff=0.01)
+
+    results = asyncio.run(write(writer, ["А", "плохое", "В"]))
+
+    assert written == ["А", "В"]
+    assert results[0] is None and results[2] is None
+    assert isinstance(results[1], asyncpg.DataError)
+    assert writer.failed == 1
+
+
+def test_shutdown_stops_retrying(monkeypatch):
+    fake_db(monkeypatch, lambda records: ConnectionRefusedError())
+    writer = bot.MemoryWriter(batch_size=10, flush_interval=0.01, max_queue=100, max_backoff=60)
+
+    async def scenario():
+        writer.start()
+        future = await writer.submit(record("А"))
+        await asyncio.sleep(0.1)
+        # Пауза между повторами долгая, но остановка ждет только последнюю попытку
+        await asyncio.wait_for(writer.close(), 1)
+        return future.exception()
+
+    assert isinstance(asyncio.run(scenario()), ConnectionRefusedError)
+    assert writer.failed == 1
+
+
+def test_failed_insert_does_not_invalidate_history(monkeypatch):
+    invalidated = []
+    unhandled = []
+
+    async def invalidate(user_id):
+        invalidated.append(user_id)
+
+    monkeypatch.setattr(bot.memory_history_cache, 'invalidate', invalidate)
+
+    async def scenario():
+        loop = asyncio.get_running_loop()
+        loop.set_exception_handler(lambda loop, context: unhandled.append(context['message']))
+        inserted = loop.create_future()
+        bot.invalidate_history_on_insert(1, inserted)
+        inserted.set_exception(ConnectionRefusedError())
+        await asyncio.sleep(0)
+        # Без обработки ошибки здесь было бы "Future exception was never retrieved"
+        del inserted
+        gc.collect()
+
+    asyncio.run(scenario())
+    assert invalidated == []
+    assert unhandled == []
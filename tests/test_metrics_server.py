@@ -0,0 +1,18 @@
+import asyncio
+import socket
+
+import bot
+
+
+def test_zero_port_disables_metrics(monkeypatch):
+    monkeypatch.setattr(bot, 'METRICS_PORT', 0)
+    assert asyncio.run(bot.start_metrics_server()) is None
+
+
+def test_busy_metrics_port_does_not_stop_bot(monkeypatch):
+    with socket.socket() as busy:
+        busy.bind(('127.0.0.1', 0))
+        busy.listen()
+        monkeypatch.setattr(bot, 'METRICS_HOST', '127.0.0.1')
+        monkeypatch.setattr(bot, 'METRICS_PORT', busy.getsockname()[1])
+        assert asyncio.run(bot.start_metrics_server()) is None
@@ -0,0 +1,159 @@
+import asyncio
+import time
+
+import pytest
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.methods import DeleteMessage, SendMessage
+
+import bot
+from bench.fakes import FakeBotAPI
+
+SERVICE_CHAT = -100
+
+
+def make_limiter():
+    return bot.OutboundRateLimitMiddleware(
+        chat_rate=1, chat_burst=1, global_rate=1000, global_burst=1000, max_retries=0,
+        service_chats={SERVICE_CHAT: (100, 10)}
+    )
+
+
+async def fake_request(_bot, method):
+    return True
+
+
+def test_service_chat_has_its_own_budget():
+    limiter = make_limiter()
+
+    async def scenario():
+        started = time.monotonic()
+        for _ in range(10):
+            await limiter(fake_request, None, SendMessage(chat_id=SERVICE_CHAT, text='warm'))
+        return time.monotonic() - started
+
+    # 10 загрузок в служебный чат не ждут по секунде, как в чате пользователя
+    assert asyncio.run(scenario()) < 0.5
+
+
+def test_service_chat_delete_skips_limiter():
+    limiter = make_limiter()
+
+    async def scenario():
+        for _ in range(10):
+            await limiter(fake_request, None, SendMessage(chat_id=SERVICE_CHAT, text='warm'))
+        started = time.monotonic()
+        for message_id in range(20):
+            await limiter(fake_request, None, DeleteMessage(chat_id=SERVICE_CHAT, message_id=message_id))
+        return time.monotonic() - started
+
+    assert asyncio.run(scenario()) < 0.05
+
+
+def test_user_chat_is_limited_and_old_cards_are_dropped():
+    limiter = make_limiter()
+    sent = []
+
+    async def request(_bot, method):
+        sent.append(method.text)
+        return True
+
+    async def render(text):
+        limiter.begin_card(1)
+        await limiter(request, None, SendMessage(chat_id=1, text=text))
+
+    async def scenario():
+        # Первая карточка уходит сразу, вторая ждет токен и устаревает, пока пользователь листает дальше
+        await render('first')
+        stale = asyncio.create_task(render('stale'))
+        await asyncio.sleep(0.1)
+        fresh = asyncio.create_task(render('fresh'))
+        with pytest.raises(bot.CardUpdateSuperseded):
+            await stale
+        await fresh
+
+    asyncio.run(scenario())
+    assert sent == ['first', 'fresh']
+    assert limiter.dropped == 1
+
+
+def run_against_fake_api(limiter, fake, sends):
+    """Отправляет сообщения настоящей сессией aiogram через limiter в фейковый Bot API"""
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+
+    async def scenario():
+        await fake.start()
+        session = AiohttpSession(api=TelegramAPIServer.from_base(fake.url))
+        session.middleware(limiter)
+        client = Bot(token=bot.API_TOKEN, session=session)
+        try:
+            return await asyncio.gather(
+                *(client.send_message(chat_id, text) for chat_id, text in sends), return_exceptions=True
+            )
+        finally:
+            await session.close()
+            await fake.close()
+
+    return asyncio.run(scenario())
+
+
+def test_limiter_stays_under_fake_telegram_limits():
+    fake = FakeBotAPI(chat_limit=10, global_limit=30)
+    limiter = bot.OutboundRateLimitMiddleware(
+        chat_rate=8, chat_burst=2, global_rate=25, global_burst=5, max_retries=0
+    )
+    # Быстрые сообщения в один чат и рассылка по многим чатам одновременно
+    sends = [(1, f"tap {i}") for i in range(12)] + [(100 + i, "broadcast") for i in range(30)]
+
+    results = run_against_fake_api(limiter, fake, sends)
+
+    assert not [result for result in results if isinstance(result, Exception)]
+    assert fake.rejected == 0
+    assert fake.calls['sendmessage'] == len(sends)
+
+
+def test_limiter_waits_retry_after_and_repeats():
+    # Telegram строже, чем настроен limiter: часть запросов получает 429
+    fake = FakeBotAPI(chat_limit=2, retry_after=1)
+    limiter = bot.OutboundRateLimitMiddleware(
+        chat_rate=100, chat_burst=100, global_rate=100, global_burst=100, max_retries=3
+    )
+
+    results = run_against_fake_api(limiter, fake, [(1, f"message {i}") for i in range(4)])
+
+    assert not [result for result in results if isinstance(result, Exception)]
+    assert fake.rejected > 0
+    assert limiter.retried == fake.rejected
+    assert fake.calls['sendmessage'] == 4
+
+
+def test_event_flow_is_not_throttled_by_default_limits(monkeypatch, fake_services):
+    user_id = 7007
+    # Лимиты по умолчанию вместо снятых фикстурой
+    limiter = bot.outbound_limiter
+    monkeypatch.setattr(limiter, 'chat_rate', bot.OUTBOUND_CHAT_RATE)
+    monkeypatch.setattr(limiter, 'chat_burst', bot.OUTBOUND_CHAT_BURST)
+    monkeypatch.setattr(limiter, '_global', bot.TokenBucket(bot.OUTBOUND_GLOBAL_RATE, bot.OUTBOUND_GLOBAL_BURST))
+    monkeypatch.setattr(limiter, '_chat_buckets', bot.OrderedDict())
+
+    async def scenario():
+        latencies = []
+        async with fake_services() as (users, _):
+            api = users.api
+
+            async def send(update):
+                started = time.monotonic()
+                await users.send(update)
+                latencies.append(time.monotonic() - started)
+
+            await send(users.message(user_id, "Поехали!"))
+            await send(users.callback(user_id, "category_concert"))
+            await send(users.callback(user_id, "date_today_concert"))
+            for _ in range(5):
+                await send(users.callback(user_id, api.callback_data(user_id, 'event_next_')))
+            return latencies, api.calls
+
+    latencies, calls = asyncio.run(scenario())
+    assert calls['deletemessage'] and calls['editmessagemedia'] == 5
+    # Ожидание токена чата заняло бы не меньше 1 / OUTBOUND_CHAT_RATE
+    assert max(latencies) < 1 / bot.OUTBOUND_CHAT_RATE
@@ -0,0 +1,77 @@
+import asyncio
+import contextlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import bot
+
+
+def test_concurrent_writes_of_same_photo(tmp_path):
+    store = bot.LocalPhotoStore(str(tmp_path))
+    content = b'same photo' * 100000
+    path = os.path.join(str(tmp_path), bot.photo_key(content))
+    threads = 50
+    barrier = threading.Barrier(threads)
+
+    def write():
+        # Все потоки стартуют одновременно, пока файла еще нет
+        barrier.wait()
+        store._write(path, content)
+
+    with ThreadPoolExecutor(threads) as executor:
+        for future in [executor.submit(write) for _ in range(threads)]:
+            future.result()
+
+    # Один файл и ни одного оставшегося временного
+    assert os.listdir(os.path.dirname(path)) == [os.path.basename(path)]
+    assert asyncio.run(store.load(path)) == content
+
+
+# S3: MinIO из TEST_S3_ENDPOINT_URL (например, http://localhost:9000), иначе moto в процессе
+TEST_S3_ENDPOINT_URL = os.getenv('TEST_S3_ENDPOINT_URL')
+TEST_S3_BUCKET = 'bot-test-memories'
+
+
+@pytest.fixture
+def s3_store():
+    pytest.importorskip('boto3')
+    if TEST_S3_ENDPOINT_URL:
+        mock = contextlib.nullcontext()
+    else:
+        moto = pytest.importorskip('moto', reason="нужен moto или TEST_S3_ENDPOINT_URL")
+        mock = moto.mock_aws()
+    with mock:
+        store = bot.S3PhotoStore(
+            TEST_S3_BUCKET,
+            endpoint_url=TEST_S3_ENDPOINT_URL,
+            access_key=os.getenv('TEST_S3_ACCESS_KEY', 'test'),
+            secret_key=os.getenv('TEST_S3_SECRET_KEY', 'test'),
+            region='us-east-1'
+        )
+        existing = {bucket['Name'] for bucket in store.client.list_buckets()['Buckets']}
+        if TEST_S3_BUCKET not in existing:
+            store.client.create_bucket(Bucket=TEST_S3_BUCKET)
+        yield store
+
+
+def test_s3_store_is_content_addressed(s3_store):
+    content = b'photo in s3' * 1000
+
+    async def scenario():
+        first = await s3_store.save(content)
+        second = await s3_store.save(content)
+        return first, second, await s3_store.load(first)
+
+    first, second, loaded = asyncio.run(scenario())
+    assert first == second == f"s3://{TEST_S3_BUCKET}/{bot.photo_key(content)}"
+    assert loaded == content
+    objects = s3_store.client.list_objects_v2(Bucket=TEST_S3_BUCKET, Prefix=bot.photo_key(content))
+    assert objects['KeyCount'] == 1
+
+
+def test_s3_store_missing_photo_is_none(s3_store):
+    missing = f"s3://{TEST_S3_BUCKET}/{bot.photo_key(b'never uploaded')}"
+    assert asyncio.run(s3_store.load(missing)) is None
@@ -0,0 +1,51 @@
+import asyncio
+
+import bot
+
+
+def test_least_recently_used_session_is_evicted():
+    store = bot.LocalSessionStore(ttl=60, max_size=2)
+
+    async def scenario():
+        await store.set('events', 1, {'index': 1})
+        await store.set('events', 2, {'index': 2})
+        # Пользователь 1 снова активен, поэтому вытесняется пользователь 2
+        await store.get('events', 1)
+        await store.set('events', 3, {'index': 3})
+        return [await store.get('events', user_id) for user_id in (1, 2, 3)]
+
+    assert asyncio.run(scenario()) == [{'index': 1}, None, {'index': 3}]
+
+
+def test_session_expires_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(bot.time, 'monotonic', lambda: now[0])
+    store = bot.LocalSessionStore(ttl=60, max_size=10)
+
+    async def scenario():
+        await store.set('memories', 7, {'current': 'x'})
+        now[0] += 59
+        alive = await store.get('memories', 7)
+        now[0] += 2
+        return alive, await store.get('memories', 7)
+
+    alive, expired = asyncio.run(scenario())
+    assert alive == {'current': 'x'}
+    assert expired is None
+    # Просроченная сессия удаляется, а не копится в памяти
+    assert len(store._sessions) == 0
+
+
+def test_session_is_stored_by_value():
+    store = bot.LocalSessionStore(ttl=60, max_size=10)
+
+    async def scenario():
+        session = {'index': 0}
+        await store.set('events', 1, session)
+        session['index'] = 5
+        loaded = await store.get('events', 1)
+        loaded['index'] = 9
+        return await store.get('events', 1)
+
+    # Как и у Redis, изменения копии не попадают в хранилище без set
+    assert asyncio.run(scenario()) == {'index': 0}
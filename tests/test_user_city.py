@@ -0,0 +1,38 @@
+import asyncio
+
+import fakeredis
+
+import bot
+
+
+def test_local_city_expires(monkeypatch):
+    monkeypatch.setattr(bot, 'user_cities', bot.OrderedDict())
+    monkeypatch.setattr(bot, 'USER_CITY_TTL', 0)
+    stored = {1: 'msk'}
+
+    async def fetch_city(name, user_id):
+        return stored[user_id]
+
+    monkeypatch.setattr(bot, 'pool', object())
+    monkeypatch.setattr(bot, 'db_fetchval', fetch_city)
+
+    async def scenario():
+        first = await bot.get_user_city(1)
+        # Другой процесс сменил город в БД: устаревшая запись не отдается
+        stored[1] = 'ekb'
+        return first, await bot.get_user_city(1)
+
+    assert asyncio.run(scenario()) == ('msk', 'ekb')
+
+
+def test_city_change_is_visible_to_other_processes_through_redis(monkeypatch):
+    monkeypatch.setattr(bot, 'redis_client', fakeredis.FakeAsyncRedis())
+    monkeypatch.setattr(bot, 'pool', None)
+
+    async def scenario():
+        assert await bot.get_user_city(1) == bot.DEFAULT_CITY
+        # Город сменили через другой процесс: в Redis уже новое значение
+        await bot.redis_client.set('user_city:1', 'nsk')
+        return await bot.get_user_city(1)
+
+    assert asyncio.run(scenario()) == 'nsk'
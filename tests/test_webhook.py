@@ -0,0 +1,49 @@
+import asyncio
+
+import aiohttp
+from aiogram.client.telegram import TelegramAPIServer
+from aiohttp import web
+
+import bot
+from bench.fakes import FakeBotAPI
+
+UPDATE = {
+    'update_id': 1,
+    'message': {
+        'message_id': 1,
+        'date': 0,
+        'chat': {'id': 8008, 'type': 'private'},
+        'from': {'id': 8008, 'is_bot': False, 'first_name': 'Test'},
+        'text': "/start",
+    },
+}
+
+
+def test_webhook_requires_secret_token(monkeypatch, unlimited_outbound):
+    monkeypatch.setattr(bot, 'WEBHOOK_SECRET', 'test-secret')
+
+    async def scenario():
+        api = await FakeBotAPI().start()
+        monkeypatch.setattr(bot.bot.session, 'api', TelegramAPIServer.from_base(api.url))
+        runner = web.AppRunner(bot.webhook_app())
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}{bot.WEBHOOK_PATH}"
+        statuses = []
+        try:
+            async with aiohttp.ClientSession() as http:
+                for headers in ({}, {'X-Telegram-Bot-Api-Secret-Token': 'wrong'},
+                                {'X-Telegram-Bot-Api-Secret-Token': 'test-secret'}):
+                    async with http.post(url, json=UPDATE, headers=headers) as response:
+                        statuses.append(response.status)
+        finally:
+            # Остановка приложения дожидается обработчиков и закрывает ресурсы бота
+            await runner.cleanup()
+            await api.close()
+        return statuses, api.calls['sendmessage']
+
+    statuses, sent = asyncio.run(scenario())
+    assert statuses == [401, 401, 200]
+    # Обработан только апдейт с верным секретом
+    assert sent == 1